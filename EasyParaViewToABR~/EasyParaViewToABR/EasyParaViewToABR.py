@@ -7,13 +7,20 @@
 # <herma582@umn.edu>
 #
 ## THIS PLUGIN USES A PACKAGED VERSION OF ABR_DATA_FORMAT AND MAY NOT BE UP TO DATE
+#
+# Compression, Skip Unchanged Sections, Static Geometry and Send Changed
+# Bricks send messages that Unity cannot read yet; they are for receivers
+# that can, such as abr_data_format/Receiver.py.
 
 import sys
 import os
+import threading
 from paraview.util.vtkAlgorithm import *
 plugin_folder = os.path.abspath(os.path.expanduser('~/EasyParaViewToABR/'))
 sys.path.append(plugin_folder)
 from abr_data_format import DataPath
+from abr_data_format.Sender import POOL, QUEUE
+from abr_data_format.Updates import SectionHashes, BrickDiff, make_attribute_update
 
 @smproxy.filter()
 
@@ -22,27 +29,64 @@ from abr_data_format import DataPath
 
 class EasyParaViewToABR(VTKPythonAlgorithmBase):
     def __init__(self):
-        VTKPythonAlgorithmBase.__init__(self, nInputPorts=1, nOutputPorts=1, outputType="vtkUnstructuredGrid")
+        VTKPythonAlgorithmBase.__init__(self, nInputPorts=1, nOutputPorts=1, outputType="vtkDataSet")
         self.dataset = 'Dataset'
         self.organization = 'Organization'
         self.key_data_name = 'KeyDataName'
         self.host  = 'localhost'
         self.port  = 1900
+        self.split_topologies = False
+        self.include_arrays = None
+        self.exclude_arrays = None
+        self.profile = False
+        self.compression = None
+        self.skip_unchanged = False
+        # Hashes of the sections last sent for each label, to the current
+        # host and port
+        self.section_hashes = SectionHashes(workers=os.cpu_count())
+        self.static_geometry = False
+        self.brick_updates = False
+        # What was last sent of each volume, brick by brick
+        self.brick_diff = BrickDiff()
+        # Labels whose mesh the current host and port have
+        self.sent_meshes = set()
+        # Held while changing the receiver and while recording what a send
+        # left it with, so that a send to the previous receiver (e.g. one
+        # still finishing in the background) is not recorded for the new one
+        self.send_lock = threading.Lock()
+        self.background = False
         self.logfile = ""
 
     def FillInputPortInformation(self, port, info):
         info.Set(self.INPUT_REQUIRED_DATA_TYPE(), "vtkDataSet")
         return 1
 
+    def RequestDataObject(self, request, inInfoVec, outInfoVec):
+        # The output is a pass-through of the input, so match its type
+        inData = self.GetInputData(inInfoVec, 0, 0)
+        outData = self.GetOutputData(outInfoVec, 0)
+        if outData is None or (not outData.IsA(inData.GetClassName())):
+            outData = inData.NewInstance()
+            outInfoVec.GetInformationObject(0).Set(outData.DATA_OBJECT(), outData)
+        return VTKPythonAlgorithmBase.RequestDataObject(self, request, inInfoVec, outInfoVec)
+
     @smproperty.stringvector(name="Host", default_values="localhost")
     def SetHost(self, value):
-        self.host = value
+        with self.send_lock:
+            self.host = value
+            self.section_hashes.forget()
+            self.brick_diff.forget()
+            self.sent_meshes.clear()
         self.Modified()
         return
 
     @smproperty.intvector(name="Port", default_values=1900)
     def SetPort(self, value):
-        self.port = value
+        with self.send_lock:
+            self.port = value
+            self.section_hashes.forget()
+            self.brick_diff.forget()
+            self.sent_meshes.clear()
         self.Modified()
 
     @smproperty.stringvector(name="1* Organization", default_values="Organization")
@@ -63,6 +107,93 @@ class EasyParaViewToABR(VTKPythonAlgorithmBase):
         self.Modified()
         return
 
+    @smproperty.intvector(name="Split Mixed Topologies", default_values=0)
+    @smdomain.xml("""<BooleanDomain name="bool"/>""")
+    def SetSplitTopologies(self, value):
+        self.split_topologies = bool(value)
+        self.Modified()
+        return
+
+    # Arrays are chosen with comma-separated glob patterns, e.g. "temp*, salinity"
+    @smproperty.stringvector(name="Include Arrays", default_values="*")
+    def SetIncludeArrays(self, value):
+        self.include_arrays = [p.strip() for p in value.split(',') if p.strip() != ''] or None
+        self.Modified()
+        return
+
+    @smproperty.stringvector(name="Exclude Arrays", default_values="")
+    def SetExcludeArrays(self, value):
+        self.exclude_arrays = [p.strip() for p in value.split(',') if p.strip() != ''] or None
+        self.Modified()
+        return
+
+    # Records the time (and memory) each conversion stage takes, as JSON
+    # lines in the log
+    @smproperty.intvector(name="Profile Conversion", default_values=0)
+    @smdomain.xml("""<EnumerationDomain name="enum">
+        <Entry value="0" text="Off"/>
+        <Entry value="1" text="Timing"/>
+        <Entry value="2" text="Timing and Memory"/>
+    </EnumerationDomain>""")
+    def SetProfile(self, value):
+        self.profile = {0: False, 1: True, 2: 'memory'}[value]
+        self.Modified()
+        return
+
+    # Compresses the payload before sending it (see Compression.py)
+    @smproperty.intvector(name="Compression", default_values=0)
+    @smdomain.xml("""<EnumerationDomain name="enum">
+        <Entry value="0" text="None"/>
+        <Entry value="1" text="zlib"/>
+        <Entry value="2" text="lzma"/>
+    </EnumerationDomain>""")
+    def SetCompression(self, value):
+        self.compression = {0: None, 1: 'zlib', 2: 'lzma'}[value]
+        self.Modified()
+        return
+
+    # Leaves the sections that did not change since the last send (e.g. the
+    # vertices and cells of a time series) out of the payload, for the
+    # receiver to take from its copy (see Updates.py)
+    @smproperty.intvector(name="Skip Unchanged Sections", default_values=0)
+    @smdomain.xml("""<BooleanDomain name="bool"/>""")
+    def SetSkipUnchanged(self, value):
+        self.skip_unchanged = bool(value)
+        if not self.skip_unchanged:
+            self.section_hashes.forget()
+        self.Modified()
+        return
+
+    # Once a label has been sent, only sends its point arrays, for time
+    # series whose mesh does not change (see Updates.py)
+    @smproperty.intvector(name="Static Geometry", default_values=0)
+    @smdomain.xml("""<BooleanDomain name="bool"/>""")
+    def SetStaticGeometry(self, value):
+        self.static_geometry = bool(value)
+        self.sent_meshes.clear()
+        self.Modified()
+        return
+
+    # Sends only the bricks of volumes that changed since the last send
+    # (see Updates.py)
+    @smproperty.intvector(name="Send Changed Bricks", default_values=0)
+    @smdomain.xml("""<BooleanDomain name="bool"/>""")
+    def SetBrickUpdates(self, value):
+        self.brick_updates = bool(value)
+        self.brick_diff.forget()
+        self.Modified()
+        return
+
+    # Sends on a background thread, so ParaView does not wait for the
+    # receiver; a dataset still waiting to be sent is replaced by a newer one
+    # of the same label, e.g. when scrubbing through time
+    @smproperty.intvector(name="Send In Background", default_values=0)
+    @smdomain.xml("""<BooleanDomain name="bool"/>""")
+    def SetBackground(self, value):
+        self.background = bool(value)
+        self.Modified()
+        return
+
     @property
     def label(self):
         path = DataPath.make_path(self.organization, self.dataset, 'KeyData', self.key_data_name)
@@ -93,7 +224,7 @@ class EasyParaViewToABR(VTKPythonAlgorithmBase):
         import numpy as np
         from vtk.numpy_interface import dataset_adapter as dsa
         import vtk
-        from abr_data_format import ABRDataFormat, UnityMeshTopology, get_unity_topology
+        from abr_data_format import ABRDataFormat, UnityMeshTopology, get_unity_topology, split_by_topology
 
         from paraview import servermanager as sm
         from paraview.simple import GetActiveView
@@ -104,34 +235,21 @@ class EasyParaViewToABR(VTKPythonAlgorithmBase):
         if 'UnitySyncer' not in dir(sm):
             self.Log("Installing Unity syncer")
             def callback(caller, *args):
-                from struct import pack
                 from paraview import servermanager as sm
                 if 'UnityModified' not in dir(sm) or sm.UnityModified == 1:
                     sm.UnityModified = 0
-                    import socket
                     sm.UnityFrame = sm.UnityFrame + 1
+                    sm.UnityLogger(sm.UnityLogfile, "update")
+                    print('Sending update')
+                    # Reuses the connection the data went over, if the
+                    # receiver keeps it open
                     try:
-                        s = socket.socket()
-                        s.connect((self.host, self.port))
-                    except:
+                        POOL.send_update(self.host, self.port)
+                    except OSError:
                         sm.UnityLogger(sm.UnityLogfile, "Update callback could not connect to {}:{}".format(self.host, self.port))
                         return
-                    else:
-                        sm.UnityLogger(sm.UnityLogfile, "update")
-                        update = 'update'.encode()
-                        print('Sending update')
-                        s.send(pack('>I', len(update)))
-                        s.send(update)
-
-                        ack_length = struct.unpack('>I', s.recv(4))[0]
-                        ack = s.recv(ack_length)
-                        print('Got ack of update')
-                        sm.UnityLogger(sm.UnityLogfile, "Got ack of update")
-
-                        ok_length = struct.unpack('>I', s.recv(4))[0]
-                        ok = s.recv(ok_length)
-                        print('Got ok of update')
-                        sm.UnityLogger(sm.UnityLogfile, "Got ok of update")
+                    print('Got ok of update')
+                    sm.UnityLogger(sm.UnityLogfile, "Got ok of update")
             def UnityLogger(fname, msg):
                 if fname != "none":
                     f = open(fname, "a")
@@ -146,19 +264,6 @@ class EasyParaViewToABR(VTKPythonAlgorithmBase):
                 self.Log("Error installing update manager")
                 print(e)
 
-        self.Log("Trying to connect to {}:{}".format(self.host, self.port))
-
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.connect((self.host, self.port))
-        except:
-            s = None
-
-        if s == None:
-            self.Log('Connection failed')
-        else:
-            self.Log('Connected')
-
         try:
             unstructured_grid = vtk.vtkUnstructuredGrid.GetData(inInfoVec[0], 0)
             vtk_data = unstructured_grid
@@ -171,78 +276,125 @@ class EasyParaViewToABR(VTKPythonAlgorithmBase):
                     else:
                         vtk_data = image_data
                 else:
-                    af = vtk.vtkAppendFilter()
-                    af.SetInputData(poly_data)
-                    af.Update()
-                    vtk_data = af.GetOutput()
-                    del af
-            formatted_data = ABRDataFormat(vtk_data, self.label)
+                    # Polydata cell arrays are read directly, no need to
+                    # append it into an unstructured grid first
+                    vtk_data = poly_data
+            options = dict(arena=True, kernel='fused', include=self.include_arrays, exclude=self.exclude_arrays,
+                compression=self.compression, compression_filters='auto' if self.compression else None,
+                workers=os.cpu_count() if self.compression else 1,
+                profile=self.profile, profile_log=self.Log)
+            if self.split_topologies:
+                all_formatted_data = split_by_topology(vtk_data, self.label, **options)
+            else:
+                all_formatted_data = [ABRDataFormat(vtk_data, self.label, **options)]
         except ValueError as e:
             print(e)
             return 0
 
-        outpt = vtk.vtkUnstructuredGrid.GetData(outInfoVec, 0)
-        outpt.ShallowCopy(formatted_data.vtk_data)
-
-        if s != None:
-
-            self.Log("Starting send of label `{}`".format(self.label))
-
-            def snd(skt, bytes):
-                offset = 0
-                knt = len(bytes)
-                while knt > 0:
-                    n = skt.send(bytes[offset:])
-                    knt = knt - n
-                    offset = offset + n
-
-            lab = self.label.encode()
-            s.send(struct.pack('>i', len(lab)))
-            s.send(lab)
-
-            self.Log("Sent label message")
-
-            stringified_json = json.dumps(formatted_data.json_header).encode()
-            s.send(struct.pack('>I', len(stringified_json)))
-            snd(s, stringified_json)
-
-            self.Log("Sent Json header message")
-
-            s.send(struct.pack('>I', formatted_data.bufsize))
-
-            if (formatted_data.data_is_unstructured):
-                snd(s, formatted_data.vertex_array.tobytes())
-                self.Log("Sent vertex array")
-
-            snd(s, formatted_data.cells.tobytes())
-
-            self.Log("Sent cells")
-
-            for i in range(len(formatted_data.json_header['scalarArrayNames'])):
-                snd(s, formatted_data.scalar_arrays[i].tobytes())
-
-            for i in range(len(formatted_data.json_header['vectorArrayNames'])):
-                snd(s, formatted_data.vector_arrays[i].tobytes())
-
-            self.Log("Finished send... waiting for ack")
-
-            # Receive the length as an int
-            length_bytes = s.recv(4)
-            ack_length = struct.unpack('>I', length_bytes)[0]
-
-            # Then receive the actual ack
-            ack = s.recv(ack_length)
-            ack = bytes(filter(lambda b: b != 0, ack))
-            ack = ack.decode()
-
-            self.Log("Got ack")
+        outpt = self.GetOutputData(outInfoVec, 0)
+        outpt.ShallowCopy(vtk_data)
+
+        if self.background:
+            from functools import partial
+            # Sent to the receiver of the time they are queued
+            host, port = self.host, self.port
+            for formatted_data in all_formatted_data:
+                QUEUE.submit((host, port, formatted_data.label), partial(self.SendFormattedData, formatted_data, host, port))
+            # The render callback may run before the data is sent, so ask
+            # for a re-render once it is
+            QUEUE.submit((host, port, 'update'), partial(self.SendRenderRequest, host, port))
+            stats = QUEUE.stats()
+            self.Log("Queued for sending; {} queued, {} sent, {} dropped, {} failed, last latency {}".format(
+                stats['depth'], stats['sent'], stats['dropped'], stats['failed'], stats['last_latency']))
+        else:
+            for formatted_data in all_formatted_data:
+                self.SendFormattedData(formatted_data, self.host, self.port)
 
-            sm.UnityModified = 1
+        self.Log('Done')
+        return 1
 
-            s.close()
-        else:
-            self.Log("No connection ... no send")
+    # Sends a dataset to a receiver, whole or as an update, and returns
+    # whether it was sent
+    def SendFormattedData(self, formatted_data, host, port):
+        label = formatted_data.label
+        if 'compression' in formatted_data.json_header:
+            return self.SendMessage(formatted_data, host, port) is not None
+
+        # Only image data is split into bricks, not unstructured volumes
+        if self.brick_updates and formatted_data.json_header.get('dimensions') is not None:
+            return self.SendUpdate(formatted_data, self.brick_diff, host, port)
+
+        if self.static_geometry:
+            if label in self.sent_meshes:
+                self.Log("Sending only the point arrays of `{}`".format(label))
+                ack = self.SendMessage(make_attribute_update(formatted_data), host, port)
+                if ack != 'missing':
+                    return ack is not None
+                self.Log("Receiver does not have the mesh of `{}`, sending all of it".format(label))
+                self.sent_meshes.discard(label)
+            if self.SendMessage(formatted_data, host, port) is None:
+                return False
+            with self.send_lock:
+                if (host, port) == (self.host, self.port):
+                    self.sent_meshes.add(label)
+            return True
+
+        if self.skip_unchanged:
+            return self.SendUpdate(formatted_data, self.section_hashes, host, port)
+        return self.SendMessage(formatted_data, host, port) is not None
+
+    # Sends the update `table` (an Updates.SectionHashes or BrickDiff) makes
+    # for a dataset, records what the receiver then has, and returns whether
+    # the receiver applied it
+    def SendUpdate(self, formatted_data, table, host, port):
+        label = formatted_data.label
+        message, state = table.make_update(formatted_data)
+        if message is not formatted_data:
+            self.Log("Sending {} of {} bytes of `{}`".format(message.bufsize, formatted_data.bufsize, label))
+        ack = self.SendMessage(message, host, port)
+        if ack == 'missing':
+            # The receiver lost the previous version, e.g. it restarted
+            self.Log("Receiver does not have the previous `{}`, sending all of it".format(label))
+            table.forget(label)
+            message, state = table.make_update(formatted_data)
+            ack = self.SendMessage(message, host, port)
+        if ack is None or ack == 'missing':
+            table.forget(label)
+            return False
+        with self.send_lock:
+            if (host, port) == (self.host, self.port):
+                table.update(label, state)
+        return True
+
+    # Asks the receiver to re-render, after sends in the background, and
+    # returns whether it did
+    def SendRenderRequest(self, host, port):
+        from paraview import servermanager as sm
 
+        try:
+            POOL.send_update(host, port)
+        except OSError as e:
+            self.Log("Update failed: {}".format(e))
+            return False
+        sm.UnityModified = 0
+        return True
+
+    # Sends one message (an ABRDataFormat, or an Updates.Message) on a
+    # pooled connection and returns the receiver's ack, or None if it was not
+    # sent or the receiver could not apply it
+    def SendMessage(self, formatted_data, host, port):
+        from paraview import servermanager as sm
 
-        self.Log('Done')
-        return 1
\ No newline at end of file
+        self.Log("Starting send of label `{}` to {}:{}".format(formatted_data.label, host, port))
+        try:
+            ack = POOL.send(host, port, formatted_data)
+        except OSError as e:
+            self.Log("Send failed: {}".format(e))
+            return None
+        if ack.startswith('error'):
+            self.Log("Receiver could not apply `{}`: {}".format(formatted_data.label, ack))
+            return None
+        self.Log("Got ack")
+
+        sm.UnityModified = 1
+        return ack
\ No newline at end of file
@@ -10,7 +10,62 @@ import vtk
 from enum import Enum
 import numpy as np
 from vtk.numpy_interface import dataset_adapter as dsa
+from vtk.util import numpy_support
 import json
+import os
+import time
+from contextlib import nullcontext
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor
+
+from .DataPath import DataPath
+from .Profile import Profile
+from .Compression import CODECS, COMPRESSION_CHUNK_SIZE, compress_buffers
+from .Filters import FILTERS, apply_filters
+from .Sender import send_buffers
+from .Conversion import CONVERSION_KERNELS, SCALAR_ENCODINGS, scalar_range, convert_scalars_encoded, scrub_into, legacy_cells_size, write_legacy_cells, fill_arange, write_point_cells
+
+# Arrays with more elements than this are split into chunks of about this
+# size when converting with several workers
+PARALLEL_CHUNK_SIZE = 1 << 22
+
+# Default most bytes of output that save() maps at once for each conversion
+# task when converting out of core
+SLAB_BUDGET = 1 << 28
+
+# Index formats: name in the header -> dtype. Unity meshes take 16-bit
+# indices for up to 65536 vertices
+INDEX_FORMATS = {
+    'int32': np.dtype('i4'),
+    'uint16': np.dtype('u2'),
+}
+
+# Stands in for a profile stage when profiling is off
+_NO_STAGE = nullcontext()
+
+# Kinds of payload section, in payload order, and their values per point
+SECTION_COMPONENTS = {
+    'vertices': 3,
+    'cells': 1,
+    'scalars': 1,
+    'vectors': 3,
+    'cell_offsets': 1,
+    'cell_counts': 1,
+}
+
+# Filters for compression_filters='auto', the best measured by `Benchmark
+# filters` on smooth surfaces and volumes: deltas from the previous point
+# (along x for volumes), with array values shuffled into byte planes.
+# Shuffling vertices, or XORing them instead, compressed worse
+AUTO_FILTERS = {
+    'vertices': ['delta'],
+    'scalars': ['delta', 'shuffle'],
+    'vectors': ['delta', 'shuffle'],
+}
+
+# Folder within the ABR media directory that holds datasets (matches
+# ABRConfig.Consts.DatasetFolder)
+DATASET_FOLDER = 'datasets'
 
 # https://docs.unity3d.com/ScriptReference/MeshTopology.html
 # https://stackoverflow.com/a/51976841
@@ -51,15 +106,308 @@ def get_unity_topology(vtk_data_type):
     except KeyError:
         return None
 
-class ABRDataFormat:
-    def __init__(self, vtk_data, label):
+def _poly_cell_types(cell_array, default_type, count_types=None):
+    # Classify one of vtkPolyData's cell arrays the same way
+    # vtkPolyData::GetCellType() does, but for all cells at once
+    if count_types is None:
+        count_types = {}
+    counts = np.diff(numpy_support.vtk_to_numpy(cell_array.GetOffsetsArray()))
+    types = np.full(counts.size, default_type, dtype=np.uint8)
+    for count, cell_type in count_types.items():
+        types[counts == count] = cell_type
+    return types
+
+def get_cell_types(vtk_data):
+    '''
+        Return the VTK cell type of every cell in `vtk_data` as a NumPy array
+        of uint8, without visiting cells one at a time. For unstructured grids
+        this is a zero-copy view of the grid's cell types array.
+    '''
+    if vtk_data.IsA('vtkUnstructuredGrid'):
+        cell_types = vtk_data.GetCellTypesArray()
+        if cell_types is None:
+            # Newer VTK versions may store the cell types implicitly, in which
+            # case there is no unsigned char array to view
+            return np.asarray(dsa.WrapDataObject(vtk_data).CellTypes)
+        return numpy_support.vtk_to_numpy(cell_types)
+    elif vtk_data.IsA('vtkPolyData'):
+        # vtkPolyData stores verts, lines, polys, then strips, in that order
+        return np.concatenate((
+            _poly_cell_types(vtk_data.GetVerts(), vtk.VTK_POLY_VERTEX, {1: vtk.VTK_VERTEX}),
+            _poly_cell_types(vtk_data.GetLines(), vtk.VTK_POLY_LINE, {2: vtk.VTK_LINE}),
+            _poly_cell_types(vtk_data.GetPolys(), vtk.VTK_POLYGON, {3: vtk.VTK_TRIANGLE, 4: vtk.VTK_QUAD}),
+            _poly_cell_types(vtk_data.GetStrips(), vtk.VTK_TRIANGLE_STRIP),
+        ))
+    else:
+        # Structured data has a single cell type; don't materialize it
+        return np.broadcast_to(np.uint8(vtk_data.GetCellType(0)), (vtk_data.GetNumberOfCells(),))
+
+def cell_type_histogram(vtk_data):
+    '''
+        Count the cells of each VTK cell type in `vtk_data`. Returns a list of
+        (cell_type, count, first_index) tuples sorted by first_index, so the
+        first entry is always the type of cell 0.
+    '''
+    num_cells = vtk_data.GetNumberOfCells()
+    if num_cells == 0:
+        return []
+    if not (vtk_data.IsA('vtkUnstructuredGrid') or vtk_data.IsA('vtkPolyData')):
+        return [(vtk_data.GetCellType(0), num_cells, 0)]
+
+    cell_types = get_cell_types(vtk_data)
+    counts = np.bincount(cell_types, minlength=256)
+    histogram = [(int(t), int(counts[t]), int(np.argmax(cell_types == t))) for t in np.flatnonzero(counts)]
+    return sorted(histogram, key=lambda h: h[2])
+
+def get_cell_arrays(vtk_data):
+    '''
+        Return the (offsets, connectivity) arrays describing the cells of an
+        unstructured grid or polydata, as NumPy arrays. Cell `i` uses points
+        `connectivity[offsets[i]:offsets[i + 1]]`. These are zero-copy views
+        of the VTK 9 cell arrays, except for polydata with more than one of
+        verts, lines, polys and strips, whose cells are concatenated.
+    '''
+    if vtk_data.IsA('vtkUnstructuredGrid'):
+        cell_arrays = [vtk_data.GetCells()]
+    else:
+        cell_arrays = [vtk_data.GetVerts(), vtk_data.GetLines(), vtk_data.GetPolys(), vtk_data.GetStrips()]
+        cell_arrays = [cell_array for cell_array in cell_arrays if cell_array.GetNumberOfCells() > 0] or cell_arrays[2:3]
+
+    all_offsets = []
+    all_connectivity = []
+    start = 0
+    for cell_array in cell_arrays:
+        offsets = numpy_support.vtk_to_numpy(cell_array.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(cell_array.GetConnectivityArray())
+        if len(cell_arrays) == 1:
+            return offsets, connectivity
+        all_offsets.append(offsets[:-1] + start)
+        all_connectivity.append(connectivity)
+        start += connectivity.size
+    all_offsets.append(np.array([start]))
+    return np.concatenate(all_offsets), np.concatenate(all_connectivity)
+
+def _select_array_names(names, include=None, exclude=None):
+    # Keep the names that match any `include` glob (all, if None) and no
+    # `exclude` glob
+    return [name for name in names
+        if (include is None or any(fnmatchcase(name, pattern) for pattern in include))
+        and not any(fnmatchcase(name, pattern) for pattern in (exclude or []))]
+
+def _select_encodings(names, scalar_encoding):
+    # One encoding per scalar array: `scalar_encoding` is an encoding for
+    # all of them, or a dict of glob pattern -> encoding where the first
+    # matching pattern wins (f32 if none match)
+    if isinstance(scalar_encoding, dict):
+        encodings = [next((e for p, e in scalar_encoding.items() if fnmatchcase(name, p)), 'f32') for name in names]
+    else:
+        encodings = [scalar_encoding] * len(names)
+    for encoding in encodings:
+        if encoding not in SCALAR_ENCODINGS:
+            raise ValueError("Unsupported scalar encoding: " + encoding)
+    return encodings
+
+class _MappedSection:
+    '''
+        Stand-in for an output array of the given dtype and shape stored at
+        byte `offset` of the file at `path`. Indexing it by a slice of the
+        first axis maps just those rows with np.memmap, so a conversion task
+        only holds its own slab in memory; the map is released with it.
+    '''
+    def __init__(self, path, offset, dtype, shape):
+        self.path = path
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(int(n) for n in shape)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def reshape(self, *shape):
+        if len(shape) == 1 and isinstance(shape[0], tuple):
+            shape = shape[0]
+        size = int(np.prod(self.shape))
+        shape = tuple(size // -int(np.prod(shape)) if n == -1 else n for n in shape)
+        return _MappedSection(self.path, self.offset, self.dtype, shape)
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        start, stop, _ = rows.indices(len(self))
+        shape = (max(0, stop - start),) + self.shape[1:]
+        if shape[0] == 0:
+            return np.empty(shape, dtype=self.dtype)[rest]
+        row_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        window = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=self.offset + start * row_bytes, shape=shape)
+        return window[rest]
+
+    def view_of(self, arena):
+        return arena[self.offset:self.offset + self.nbytes].view(self.dtype).reshape(self.shape)
+
+class PayloadWriter:
+    '''
+        Writes a binary payload to files and sockets, for ABRDataFormat and
+        the classes sent like it (ABRDataReader, Updates.Message).
+        Subclasses give `get_buffers()`, the payload as a list of byte
+        buffers, and may set `profile` to a Profile to record the 'write'
+        stage.
+    '''
+    profile = None
+
+    def _stage(self, name, nbytes=0):
+        # A shared no-op unless profiling, so disabled profiling costs nothing
+        if self.profile is None:
+            return _NO_STAGE
+        return self.profile.stage(name, nbytes)
+
+    def write_into(self, target, header=b''):
+        '''
+            Write the binary payload to a writable file object or a connected
+            socket, one section at a time, without concatenating the sections.
+            The bytes of `header` (e.g. the socket protocol's framing) are
+            written first; to a socket, they go out in the same scatter-gather
+            send as the sections. Returns the number of bytes written.
+        '''
+        buffers = self.get_buffers()
+        with self._stage('write', sum(len(buf) for buf in buffers)):
+            buffers = [memoryview(header)] + list(buffers)
+            if hasattr(target, 'sendall'):
+                send_buffers(target, buffers)
+            else:
+                for buf in buffers:
+                    # Raw (unbuffered) files may write only part of the buffer
+                    offset = 0
+                    while offset < len(buf):
+                        offset += target.write(buf[offset:])
+        return sum(len(buf) for buf in buffers)
+
+    def get_data_bytes(self):
+        return b''.join(self.get_buffers())
+
+class ABRDataFormat(PayloadWriter):
+    '''
+        Converts a VTK dataset into the JSON header and binary payload that
+        ABR's `RawDataset` expects.
+
+        With `arena=True`, a single buffer of `bufsize` bytes is allocated up
+        front and every array is converted directly into its final place in
+        it; `vertex_array`, `cells`, `scalar_arrays` and `vector_arrays` are
+        then views into `arena`, which is the payload itself.
+
+        With `deferred=True`, arrays are laid out the same way but not
+        converted until the payload is first needed, so `save()` can convert
+        them straight into the output file, out of core: each array is
+        converted a slab at a time (z slabs for volumes) into a memory map of
+        just that part of the file, so memory use beyond the VTK data itself
+        is bounded by `save()`'s `slab_budget`. `scalarMins` and
+        `scalarMaxes` in `json_header` are only filled in at that point.
+
+        `include` and `exclude` are lists of glob patterns (e.g. `['temp*']`)
+        choosing which point data arrays to convert; arrays that are not
+        selected are never read.
+
+        `kernel` picks how scalar arrays are scrubbed, cast and scanned for
+        their range: 'reference' (whole-array NumPy operations) or 'fused'
+        (one cache-sized block at a time); see `Conversion.py`.
+
+        With `workers=N` (N > 1), arrays, and chunks of large arrays, are
+        converted on a pool of N threads; NumPy releases the GIL for this
+        work. The output is byte-identical to the serial path. `timings`
+        records the conversion wall time, the CPU time spent in conversion,
+        and the speedup achieved (their ratio).
+
+        Cells are read from the VTK 9 offsets and connectivity arrays, so
+        polydata can be passed in directly. `index_layout` picks how they are
+        sent: 'legacy' (the default) interleaves a count before each cell's
+        indices, which is what `RawDataset` parses today; 'offsets' sends
+        just the point indices and appends `cellIndexOffsets` and
+        `cellIndexCounts` sections after the vector arrays, ready for the
+        matching `RawDataset` fields.
+
+        For point and volume topologies every point is its own cell, so the
+        cell indices are just 0..N-1. They are generated directly as int32,
+        or with `implicit_point_indices=True` left out of the payload
+        entirely and flagged as `implicitPointIndices` in the header.
+
+        `index_format` picks the type of the cell indices: 'int32' (the
+        default, what `RawDataset` reads today), 'uint16' (half the bytes,
+        for data with at most 65536 points, or ValueError), or 'auto',
+        which uses 'uint16' whenever the indices fit. Cell offsets and
+        counts stay int32. Anything but int32 is recorded as
+        `indexFormat` in the header.
+
+        `scalar_encoding` picks how scalar arrays are stored: 'f32' (the
+        default), 'f16', or normalized to the array's range, 'u16norm' or
+        'u8norm' (value = scalarMin + q / (2^bits - 1) * (scalarMax -
+        scalarMin)). It is one encoding for all arrays or a dict of glob
+        pattern -> encoding, e.g. `{'temp*': 'u8norm'}`. Unless all arrays
+        are f32, the encodings are listed as `scalarEncodings` in the
+        header, in the order of `scalarArrayNames`. See `Conversion.py`.
+
+        With `compression='zlib'` or `'lzma'`, the payload is split into
+        chunks of at most `compression_chunk_size` bytes, compressed on
+        `workers` threads at `compression_level`, and framed with each
+        chunk's sizes (see `Compression.py`). `get_buffers()` and
+        `write_into()` then give the framed payload, `bufsize` is its size,
+        and `compression` in the header gives the codec, the chunk size
+        and the uncompressed size. With `deferred=True` this happens when
+        the payload is first needed.
+
+        `compression_filters` precondition sections before they are
+        compressed (see `Filters.py`): a dict of section kind ('vertices',
+        'cells', 'scalars', 'vectors', 'cell_offsets' or 'cell_counts') ->
+        list of filters ('delta', 'xor', 'shuffle'), applied in order, or
+        'auto' for AUTO_FILTERS. The filters of each section, in payload
+        order, are listed as `filters` in the header's `compression`.
+
+        With `profile=True`, `profile` is a `Profile` recording the wall
+        time and bytes produced by each stage (cell type scan, wrapping,
+        cell arrays, conversion of each kind of array, writing); with
+        `profile='memory'`, also the peak memory each stage allocated, via
+        tracemalloc. Each record is also passed as a line of JSON to
+        `profile_log`, if given. With several workers, the conversion
+        stages overlap, so they are recorded as a single 'convert' stage.
+        Converting out of core in `save()` is recorded as one 'save' stage.
+        Without profiling, `profile` is None and nothing is measured.
+    '''
+    def __init__(self, vtk_data, label, arena=False, deferred=False, include=None, exclude=None, kernel='reference', workers=1, index_layout='legacy', implicit_point_indices=False, index_format='int32', scalar_encoding='f32', compression=None, compression_level=None, compression_chunk_size=COMPRESSION_CHUNK_SIZE, compression_filters=None, profile=False, profile_log=None):
         self.json_header = None
         self.label = label
         self.bufsize = None
         self.vertex_array = None
         self.cells = None
+        self.cell_index_offsets = None
+        self.cell_index_counts = None
         self.scalar_arrays = None
         self.vector_arrays = None
+        self.cell_type_histogram = None
+        self.arena = None
+        self._pending = None
+        self._kernel = CONVERSION_KERNELS[kernel]
+        self._workers = workers
+        if index_layout not in ('legacy', 'offsets'):
+            raise ValueError("Unsupported index layout: " + index_layout)
+        self.index_layout = index_layout
+        if index_format not in INDEX_FORMATS and index_format != 'auto':
+            raise ValueError("Unsupported index format: " + index_format)
+        self.index_format = 'int32'
+        self.scalar_encodings = []
+        if compression is not None and compression not in CODECS:
+            raise ValueError("Unsupported compression codec: " + compression)
+        if compression_filters is not None and compression is None:
+            raise ValueError("compression_filters need a compression codec")
+        if compression_filters is not None and compression_filters != 'auto':
+            for kind, filters in compression_filters.items():
+                if kind not in SECTION_COMPONENTS:
+                    raise ValueError("Unsupported section kind: " + kind)
+                for name in filters:
+                    if name not in FILTERS:
+                        raise ValueError("Unsupported filter: " + name)
+        self._compression = None
+        self._compressed = None
+        self.implicit_point_indices = False
+        self.timings = {}
+        self.profile = Profile(label, memory=profile == 'memory', log=profile_log) if profile else None
         self.vtk_data = vtk_data
         vtk_data_type = self.vtk_data.GetDataObjectType()
         self.data_is_unstructured = vtk_data_type == vtk.vtkUnstructuredGrid().GetDataObjectType() or vtk_data_type == vtk.vtkPolyData().GetDataObjectType()
@@ -72,51 +420,55 @@ class ABRDataFormat:
 
         if self.vtk_data.GetNumberOfCells() > 0:
 
-            first_cell_type = self.vtk_data.GetCell(0).GetCellType()
+            with self._stage('cell_types'):
+                self.cell_type_histogram = cell_type_histogram(self.vtk_data)
+            first_cell_type = self.cell_type_histogram[0][0]
             topology = VTK_TO_TOPOLOGY[first_cell_type]
-            differences = [self.vtk_data.GetCell(i).GetCellType() for i in range(self.vtk_data.GetNumberOfCells()) if first_cell_type != self.vtk_data.GetCell(i).GetCellType()]
-            if len(differences) > 0:
-                print('WARNING (label {}): {} discrepancies found from first cell type!'.format(label, len(differences)))
+            if len(self.cell_type_histogram) > 1:
+                discrepancies = num_cells - self.cell_type_histogram[0][1]
+                print('WARNING (label {}): {} discrepancies found from first cell type!'.format(label, discrepancies))
                 print('    Make sure all cells are of the same type.')
                 print('    First cell is of type: {}'.format(first_cell_type))
-                print('    First difference fromm first cell type: {}'.format(differences[0]))
-
-            np_dataset = dsa.WrapDataObject(self.vtk_data)
-
-            self.scalar_arrays = []
-            self.vector_arrays = []
-
-            scalar_mins = []
-            scalar_maxes = []
-            scalar_array_names = []
-            vector_array_names = []
-
-            point_data = np_dataset.PointData
-
-            # quietly ignore any arrays that are not scalar or 3-vector
-
-            for name, arr in zip(point_data.keys(), point_data):
-                if len(arr.shape) == 1 or arr.shape[1] == 1:
-                    arr = np.nan_to_num(arr).astype('f4')
-                    scalar_array_names.append(name)
-                    self.scalar_arrays.append(arr)
-                    scalar_mins.append(float(np.amin(arr)))
-                    scalar_maxes.append(float(np.max(arr)))
-                elif len(arr.shape) == 2 and arr.shape[1] == 3:
-                    arr = np.nan_to_num(arr).astype('f4')
-                    self.vector_arrays.append(arr)
-                    vector_array_names.append(name)
-
-            # Flip the z component of vector assuming it's a 3-vec. This also is based on
-            # the assumption that a 3-vec represents something spatial, and that Paraview
-            # is right-handed and Unity is left-handed. Also flip z for scalars if data is
-            # volumetric. Also convert NANs and create list of dicts
-            if (self.data_is_unstructured):
-                self.vertex_array = np.nan_to_num(np_dataset.Points * [1, 1, -1]).astype('f4')
-            else:
+                print('    Cell types found (type, count, first index):')
+                for cell_type, count, first_index in self.cell_type_histogram:
+                    print('        {}, {}, {}'.format(cell_type, count, first_index))
+
+            with self._stage('wrap'):
+                np_dataset = dsa.WrapDataObject(self.vtk_data)
+
+                self.scalar_arrays = []
+                self.vector_arrays = []
+
+                scalar_mins = []
+                scalar_maxes = []
+                scalar_array_names = []
+                vector_array_names = []
+                scalar_sources = []
+                vector_sources = []
+
+                point_data = np_dataset.PointData
+                vtk_point_data = self.vtk_data.GetPointData()
+
+                # quietly ignore any arrays that are not scalar or 3-vector, and
+                # only wrap the arrays that were selected
+
+                for name in _select_array_names(point_data.keys(), include, exclude):
+                    vtk_arr = vtk_point_data.GetArray(name)
+                    if vtk_arr is None:
+                        continue
+                    components = vtk_arr.GetNumberOfComponents()
+                    if components == 1:
+                        scalar_array_names.append(name)
+                        scalar_sources.append(point_data[name])
+                    elif components == 3:
+                        vector_array_names.append(name)
+                        vector_sources.append(point_data[name])
+
+            self.scalar_encodings = _select_encodings(scalar_array_names, scalar_encoding)
+            quantized = any(encoding != 'f32' for encoding in self.scalar_encodings)
+
+            if not self.data_is_unstructured:
                 dimensions = self.vtk_data.GetDimensions()
-                for i in range(len(self.scalar_arrays)):
-                    self.scalar_arrays[i] = np.nan_to_num(np.flip(self.scalar_arrays[i].reshape(dimensions[2], dimensions[1], dimensions[0]), 0).flatten())
 
             if (topology == UnityMeshTopology.Lines) or (topology == UnityMeshTopology.Triangles)or (topology == UnityMeshTopology.Quads) or (topology == UnityMeshTopology.LineStrip):
                 k = 1
@@ -124,12 +476,87 @@ class ABRDataFormat:
                 k = 0
 
             if k == 0:
-                cells = np.column_stack(([1]*np_dataset.GetNumberOfPoints(), np.arange(np_dataset.GetNumberOfPoints()))).flatten()
+                # Every point is a cell; the indices are generated later
                 num_cells = np_dataset.GetNumberOfPoints()
+                cell_arrays = None
+                self.implicit_point_indices = implicit_point_indices
+            else:
+                # Zero-copy views of the VTK 9 cell arrays
+                with self._stage('cell_arrays'):
+                    cell_arrays = get_cell_arrays(self.vtk_data)
+
+            if self.implicit_point_indices:
+                num_cell_indices = 0
+            elif cell_arrays is None:
+                num_cell_indices = 2*num_cells if self.index_layout == 'legacy' else num_cells
+            elif self.index_layout == 'legacy':
+                num_cell_indices = legacy_cells_size(*cell_arrays)
             else:
-                cells = np_dataset.Cells
+                num_cell_indices = cell_arrays[1].size
+
+            if index_format != 'int32' and num_cell_indices > 0:
+                # In the legacy layout the cell sizes are stored among the
+                # indices, so they have to fit too
+                fits = num_points <= 1 << 16
+                if fits and cell_arrays is not None and self.index_layout == 'legacy':
+                    fits = np.diff(cell_arrays[0]).max() < 1 << 16
+                if fits:
+                    self.index_format = 'uint16'
+                elif index_format == 'uint16':
+                    raise ValueError("{} has too many points for uint16 indices".format(label))
+            index_size = INDEX_FORMATS[self.index_format].itemsize
+
+            # Get total size of data block
+            bufsize = 0
+
+            # space for points
+            if (self.data_is_unstructured):
+                bufsize = bufsize + 4*(3*num_points)
+
+            # add space for point-dep variables
+            bufsize = bufsize + sum(SCALAR_ENCODINGS[encoding].itemsize for encoding in self.scalar_encodings) * num_points
+            bufsize = bufsize + 4*(3*len(vector_array_names) * num_points)
 
-            self.cells = cells.astype('i4')
+            # add space for indices, and for cell offsets and counts
+            offsets_size = 4*2*num_cells if self.index_layout == 'offsets' and not self.implicit_point_indices else 0
+            self.bufsize = bufsize + index_size*num_cell_indices + offsets_size
+
+            pending = (np_dataset, cell_arrays, num_cells, scalar_sources, vector_sources, dimensions, scalar_mins, scalar_maxes)
+            if arena or deferred:
+                self._pending = pending
+                if not deferred:
+                    self._convert_pending(np.empty(self.bufsize, dtype=np.uint8))
+            elif kernel != 'reference' or workers > 1 or quantized:
+                self._convert_arrays(lambda dtype, shape: np.empty(shape, dtype=dtype), *pending)
+            else:
+                with self._stage('scalars', 4*len(scalar_sources)*num_points):
+                    for arr in scalar_sources:
+                        arr = np.nan_to_num(arr).astype('f4')
+                        self.scalar_arrays.append(arr)
+                        scalar_mins.append(float(np.amin(arr)))
+                        scalar_maxes.append(float(np.max(arr)))
+                with self._stage('vectors', 4*3*len(vector_sources)*num_points):
+                    for arr in vector_sources:
+                        self.vector_arrays.append(np.nan_to_num(arr).astype('f4'))
+
+                # Flip the z component of vector assuming it's a 3-vec. This also is based on
+                # the assumption that a 3-vec represents something spatial, and that Paraview
+                # is right-handed and Unity is left-handed. Also flip z for scalars if data is
+                # volumetric. Also convert NANs and create list of dicts
+                if (self.data_is_unstructured):
+                    with self._stage('vertices', 4*3*num_points):
+                        self.vertex_array = np.nan_to_num(np_dataset.Points * [1, 1, -1]).astype('f4')
+                else:
+                    with self._stage('volume_flip'):
+                        for i in range(len(self.scalar_arrays)):
+                            self.scalar_arrays[i] = np.nan_to_num(np.flip(self.scalar_arrays[i].reshape(dimensions[2], dimensions[1], dimensions[0]), 0).flatten())
+
+                allocate = lambda dtype, shape: np.empty(shape, dtype=dtype)
+                run_now = lambda scalar_index, func, length, itemsize, row_size=1: func(slice(0, length))
+                with self._stage('cells', index_size*num_cell_indices):
+                    self._convert_cells(allocate, cell_arrays, num_cells, run_now)
+                with self._stage('cell_offsets', offsets_size):
+                    self._convert_cell_offsets(allocate, cell_arrays, num_cells, run_now)
 
             b = np.array(np_dataset.VTKObject.GetBounds())
             c = ((b[[1,3,5]] + b[[0,2,4]]) / 2.0).tolist()
@@ -147,7 +574,7 @@ class ABRDataFormat:
                 'meshTopology': int(topology),
                 'num_points': num_points,
                 'num_cells': num_cells,
-                'num_cell_indices': cells.size,
+                'num_cell_indices': num_cell_indices,
                 'scalarArrayNames': scalar_array_names,
                 'vectorArrayNames': vector_array_names,
                 'bounds': bounds,
@@ -156,31 +583,419 @@ class ABRDataFormat:
                 'scalarMins': scalar_mins
             }
 
+            if self.index_layout != 'legacy':
+                data['indexLayout'] = self.index_layout
+            if self.implicit_point_indices:
+                data['implicitPointIndices'] = True
+            if self.index_format != 'int32':
+                data['indexFormat'] = self.index_format
+            if quantized:
+                data['scalarEncodings'] = self.scalar_encodings
+
             self.json_header = data
 
-            # Get total size of data block
-            bufsize = 0
+            if compression is not None:
+                if compression_filters == 'auto':
+                    compression_filters = AUTO_FILTERS
+                self._compression = (compression, compression_level, compression_chunk_size, compression_filters)
+                if not deferred:
+                    self._compress()
+        else:
+            raise ValueError("Unstructured grid contains no cells")
 
-            # space for points
+    def _convert_pending(self, arena):
+        pending = self._pending
+        self._pending = None
+        self.arena = arena
+        offset = 0
+
+        def take(dtype, shape):
+            nonlocal offset
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            view = arena[offset:offset + nbytes].view(dtype).reshape(shape)
+            offset += nbytes
+            return view
+
+        self._convert_arrays(take, *pending)
+
+    def _convert_pending_to_file(self, path, slab_budget, stage=None):
+        # Out of core: every array is a _MappedSection of the file, and
+        # each task maps only the slab it converts
+        pending = self._pending
+        self._pending = None
+        offset = 0
+
+        def take(dtype, shape):
+            nonlocal offset
+            section = _MappedSection(path, offset, dtype, shape)
+            offset += section.nbytes
+            return section
+
+        self._convert_arrays(take, *pending, slab_budget=slab_budget, stage=stage)
+
+        # Point the arrays at a read-only map of the finished file (np.memmap
+        # cannot map an empty file)
+        if self.bufsize > 0:
+            self.arena = np.memmap(path, dtype=np.uint8, mode='r', shape=(self.bufsize,))
+        else:
+            self.arena = np.empty(0, dtype=np.uint8)
+        if self.vertex_array is not None:
+            self.vertex_array = self.vertex_array.view_of(self.arena)
+        self.cells = self.cells.view_of(self.arena)
+        self.scalar_arrays = [arr.view_of(self.arena) for arr in self.scalar_arrays]
+        self.vector_arrays = [arr.view_of(self.arena) for arr in self.vector_arrays]
+        if self.cell_index_offsets is not None:
+            self.cell_index_offsets = self.cell_index_offsets.view_of(self.arena)
+            self.cell_index_counts = self.cell_index_counts.view_of(self.arena)
+
+    def _convert_arrays(self, take, np_dataset, cell_arrays, num_cells, scalar_sources, vector_sources, dimensions, scalar_mins, scalar_maxes, chunk_size=None, slab_budget=None, stage=None):
+        # Convert every array straight into its output, as given by
+        # take(dtype, shape). Arrays are taken in the same order as
+        # get_buffers(): vertices, cells, scalars, vectors. The work is
+        # queued as (scalar index or None, function) tasks over chunks of
+        # the first axis of about `chunk_size` elements (default: whole
+        # arrays, or PARALLEL_CHUNK_SIZE with several workers), so it can be
+        # spread across threads, and of at most about `slab_budget` bytes of
+        # output, from the output's own item size, to keep within a memory
+        # budget. Tasks are grouped into the profile's stages as they are
+        # queued, or all recorded as the one stage `stage`, if given.
+        tasks = []
+        stages = []
+        if chunk_size is None and self._workers > 1:
+            chunk_size = PARALLEL_CHUNK_SIZE
+
+        def row_chunks(length, itemsize, row_size=1):
+            # Rows of `row_size` output elements of `itemsize` bytes each
+            rows = length if chunk_size is None else max(1, chunk_size // row_size)
+            if slab_budget is not None:
+                rows = min(rows, max(1, slab_budget // (row_size * itemsize)))
+            return [slice(start, start + rows) for start in range(0, length, rows)]
+
+        def add_chunked_tasks(scalar_index, func, length, itemsize, row_size=1):
+            for chunk in row_chunks(length, itemsize, row_size):
+                tasks.append((scalar_index, lambda chunk=chunk: func(chunk)))
+
+        def quantize(src, out, encoding, clamp, chunks):
+            # The whole array's range is needed before any of it can be
+            # quantized, so this is one task: scan, then quantize
+            ranges = [scalar_range(src[chunk], self._kernel, clamp) for chunk in chunks]
+            value_range = (min(r[0] for r in ranges), max(r[1] for r in ranges))
+            for chunk in chunks:
+                convert_scalars_encoded(src[chunk], out[chunk], encoding, self._kernel, clamp, value_range)
+            return value_range
+
+        def begin_stage(name):
+            # Tasks and output taken from here on belong to stage `name`
+            stages.append([name, len(tasks), 0])
+
+        def take_in_stage(dtype, shape, take=take):
+            stages[-1][2] += int(np.prod(shape)) * np.dtype(dtype).itemsize
+            return take(dtype, shape)
+
+        if (self.data_is_unstructured):
+            begin_stage('vertices')
+            self.vertex_array = take_in_stage('f4', (self.vtk_data.GetNumberOfPoints(), 3))
+            points = np_dataset.Points
+
+            def convert_points(chunk, out=self.vertex_array):
+                # Flip z (right-handed ParaView to left-handed Unity). The
+                # points are promoted to float64 before scrubbing, so only
+                # NaNs change
+                out = out[chunk]
+                np.copyto(out[:, :2], points[chunk, :2], casting='unsafe')
+                np.negative(points[chunk, 2], out=out[:, 2], casting='unsafe')
+                np.nan_to_num(out, copy=False, posinf=np.inf, neginf=-np.inf)
+            add_chunked_tasks(None, convert_points, len(self.vertex_array), 4, 3)
+
+        begin_stage('cells')
+        self._convert_cells(take_in_stage, cell_arrays, num_cells, add_chunked_tasks)
+
+        begin_stage('scalars')
+        for i, arr in enumerate(scalar_sources):
+            encoding = self.scalar_encodings[i]
             if (self.data_is_unstructured):
-                bufsize = bufsize + 4*(3*num_points)
+                out = take_in_stage(SCALAR_ENCODINGS[encoding], arr.shape)
+                src, clamp, row_size = arr, False, 1
+            else:
+                # Flip z for volumes while converting
+                out = take_in_stage(SCALAR_ENCODINGS[encoding], (dimensions[2], dimensions[1], dimensions[0]))
+                src, clamp, row_size = np.flip(arr.reshape(out.shape), 0), True, dimensions[1] * dimensions[0]
+            itemsize = out.dtype.itemsize
+            if encoding == 'f32':
+                add_chunked_tasks(i, lambda chunk, src=src, out=out, clamp=clamp: self._kernel(src[chunk], out[chunk], clamp=clamp), len(out), itemsize, row_size)
+            elif encoding == 'f16':
+                add_chunked_tasks(i, lambda chunk, src=src, out=out, clamp=clamp: convert_scalars_encoded(src[chunk], out[chunk], 'f16', self._kernel, clamp),
+                    len(out), itemsize, row_size)
+            else:
+                tasks.append((i, lambda src=src, out=out, encoding=encoding, clamp=clamp, chunks=row_chunks(len(out), itemsize, row_size):
+                    quantize(src, out, encoding, clamp, chunks)))
+            self.scalar_arrays.append(out.reshape(-1))
 
-            # add space for point-dep variables
-            bufsize = bufsize + 4*((len(scalar_array_names) + 3*len(vector_array_names)) * num_points)
+        begin_stage('vectors')
+        for arr in vector_sources:
+            out = take_in_stage('f4', arr.shape)
+            add_chunked_tasks(None, lambda chunk, arr=arr, out=out: scrub_into(arr[chunk], out[chunk]), len(out), 4, 3)
+            self.vector_arrays.append(out)
+
+        # Appended after the vectors, so the sections RawDataset already
+        # reads keep their positions
+        begin_stage('cell_offsets')
+        self._convert_cell_offsets(take_in_stage, cell_arrays, num_cells, add_chunked_tasks)
 
-            # add space for indices
-            self.bufsize = bufsize + 4*cells.size
+        def run(task):
+            # CPU time of the worker thread, so the sum over tasks estimates
+            # the serial time even when threads share cores
+            start = time.thread_time()
+            result = task[1]()
+            return result, time.thread_time() - start
+
+        start = time.perf_counter()
+        if self._workers > 1:
+            with self._stage(stage or 'convert', sum(nbytes for _, _, nbytes in stages)):
+                with ThreadPoolExecutor(self._workers) as pool:
+                    results = list(pool.map(run, tasks))
+        elif stage is not None:
+            with self._stage(stage, sum(nbytes for _, _, nbytes in stages)):
+                results = [run(task) for task in tasks]
         else:
-            raise ValueError("Unstructured grid contains no cells")
+            results = []
+            ends = [first for _, first, _ in stages[1:]] + [len(tasks)]
+            for (name, first, nbytes), end in zip(stages, ends):
+                with self._stage(name, nbytes):
+                    results.extend(run(task) for task in tasks[first:end])
+        wall_seconds = time.perf_counter() - start
 
-    def get_data_bytes(self):
-        final_bytes = bytes()
+        # Combine the value ranges of each scalar array's chunks
+        ranges = {}
+        for (scalar_index, _), (value_range, _) in zip(tasks, results):
+            if scalar_index is not None:
+                low, high = ranges.get(scalar_index, value_range)
+                ranges[scalar_index] = (min(low, value_range[0]), max(high, value_range[1]))
+        for i in range(len(scalar_sources)):
+            scalar_mins.append(ranges[i][0])
+            scalar_maxes.append(ranges[i][1])
+
+        cpu_seconds = sum(seconds for _, seconds in results)
+        self.timings['convert_seconds'] = wall_seconds
+        self.timings['convert_cpu_seconds'] = cpu_seconds
+        self.timings['convert_workers'] = self._workers
+        self.timings['convert_speedup'] = cpu_seconds / wall_seconds if wall_seconds > 0 else 1.0
+
+    def _convert_cells(self, take, cell_arrays, num_cells, add_chunked_tasks):
+        index_dtype = INDEX_FORMATS[self.index_format]
+        if self.implicit_point_indices:
+            self.cells = take(index_dtype, (0,))
+        elif cell_arrays is None:
+            # Point cells: a strided int32 fill, nothing to read
+            if self.index_layout == 'legacy':
+                self.cells = take(index_dtype, (2*num_cells,))
+                rows = self.cells.reshape(num_cells, 2)
+                add_chunked_tasks(None, lambda chunk: write_point_cells(rows[chunk], chunk.start), num_cells, index_dtype.itemsize, 2)
+            else:
+                self.cells = take(index_dtype, (num_cells,))
+                add_chunked_tasks(None, lambda chunk, out=self.cells: fill_arange(out[chunk], chunk.start), num_cells, index_dtype.itemsize)
+        else:
+            offsets, connectivity = cell_arrays
+            if self.index_layout == 'legacy':
+                self.cells = take(index_dtype, (legacy_cells_size(offsets, connectivity),))
+                add_chunked_tasks(None, lambda chunk, out=self.cells: write_legacy_cells(offsets, connectivity, out, chunk.start, min(chunk.stop, num_cells)),
+                    num_cells, index_dtype.itemsize, max(1, connectivity.size // max(1, num_cells)) + 1)
+            else:
+                self.cells = take(index_dtype, connectivity.shape)
+                add_chunked_tasks(None, lambda chunk, out=self.cells: np.copyto(out[chunk], connectivity[chunk], casting='unsafe'), connectivity.size, index_dtype.itemsize)
+
+    def _convert_cell_offsets(self, take, cell_arrays, num_cells, add_chunked_tasks):
+        if self.index_layout != 'offsets' or self.implicit_point_indices:
+            return
+        self.cell_index_offsets = take('i4', (num_cells,))
+        self.cell_index_counts = take('i4', (num_cells,))
+        if cell_arrays is None:
+            add_chunked_tasks(None, lambda chunk, out=self.cell_index_offsets: fill_arange(out[chunk], chunk.start), num_cells, 4)
+            add_chunked_tasks(None, lambda chunk, out=self.cell_index_counts: out[chunk].fill(1), num_cells, 4)
+        else:
+            offsets = cell_arrays[0]
+            add_chunked_tasks(None, lambda chunk, out=self.cell_index_offsets: np.copyto(out[chunk], offsets[:-1][chunk], casting='unsafe'), num_cells, 4)
+            add_chunked_tasks(None, lambda chunk, out=self.cell_index_counts: np.subtract(offsets[1:][chunk], offsets[:-1][chunk], out=out[chunk], casting='unsafe'), num_cells, 4)
+
+    def get_buffers(self):
+        '''
+            Return the binary payload as an ordered list of byte memoryviews
+            over the converted arrays: vertices (unstructured data only),
+            cells, scalar arrays, then vector arrays. This is the order
+            `RawDataset.BinaryData.Decode` reads them in. With the 'offsets'
+            index layout, cell offsets and counts follow. No data is copied.
+            With compression, this is the framed compressed payload instead.
+        '''
+        if self._compression is not None:
+            if self._compressed is None:
+                self._compress()
+            return self._compressed
+        return self._raw_buffers()
+
+    def _compress(self):
+        codec, level, chunk_size, filters = self._compression
+        buffers = self._raw_buffers()
+        compression = {'codec': codec, 'chunkSize': chunk_size, 'rawSize': self.bufsize}
+        if filters:
+            sections = self._sections()
+            section_filters = [filters.get(kind, []) for kind, _ in sections]
+            with self._stage('filter', self.bufsize):
+                buffers = [apply_filters(arr, f, SECTION_COMPONENTS[kind]) if f else memoryview(np.ascontiguousarray(arr)).cast('B')
+                    for (kind, arr), f in zip(sections, section_filters)]
+            if any(section_filters):
+                compression['filters'] = section_filters
+        with self._stage('compress', self.bufsize):
+            self._compressed = compress_buffers(buffers, codec, level, chunk_size, self._workers)
+        self.json_header['compression'] = compression
+        self.bufsize = sum(len(buf) for buf in self._compressed)
+
+    def _sections(self):
+        # (kind, array) of each section of the converted payload, in order
+        sections = []
         if (self.data_is_unstructured):
-            final_bytes += self.vertex_array.tobytes()
-        final_bytes += self.cells.tobytes()
-        for i in range(len(self.json_header['scalarArrayNames'])):
-            final_bytes += self.scalar_arrays[i].tobytes()
-
-        for i in range(len(self.json_header['vectorArrayNames'])):
-            final_bytes += self.vector_arrays[i].tobytes()
-        return final_bytes
\ No newline at end of file
+            sections.append(('vertices', self.vertex_array))
+        sections.append(('cells', self.cells))
+        sections.extend(('scalars', arr) for arr in self.scalar_arrays[:len(self.json_header['scalarArrayNames'])])
+        sections.extend(('vectors', arr) for arr in self.vector_arrays[:len(self.json_header['vectorArrayNames'])])
+        if self.cell_index_offsets is not None:
+            sections.extend([('cell_offsets', self.cell_index_offsets), ('cell_counts', self.cell_index_counts)])
+        return sections
+
+    def get_named_sections(self):
+        '''
+            The sections of the converted, uncompressed payload as (name,
+            array) pairs, in payload order. Names are 'vertices', 'cells',
+            'scalars/<array name>', 'vectors/<array name>', 'cell_offsets'
+            and 'cell_counts', as `ABRDataReader.get_section_names` gives.
+        '''
+        if self._pending is not None:
+            self._convert_pending(np.empty(self.bufsize, dtype=np.uint8))
+        names = {
+            'scalars': iter(self.json_header['scalarArrayNames']),
+            'vectors': iter(self.json_header['vectorArrayNames']),
+        }
+        return [(kind + '/' + next(names[kind]) if kind in names else kind, arr) for kind, arr in self._sections()]
+
+    def _raw_buffers(self):
+        if self._pending is not None:
+            self._convert_pending(np.empty(self.bufsize, dtype=np.uint8))
+        if self.arena is not None:
+            return [memoryview(self.arena)]
+        return [memoryview(np.ascontiguousarray(arr)).cast('B') for _, arr in self._sections()]
+
+    def save(self, media_dir, slab_budget=SLAB_BUDGET):
+        '''
+            Write the header and payload to `<media_dir>/datasets/<label>.json`
+            and `.bin`, where Unity's `MediaDataLoader` looks for them,
+            creating the Organization/Dataset/KeyData folders as needed.
+
+            The payload goes through a memory map sized from `bufsize`, so it
+            is never assembled in RAM. With `deferred=True` the arrays are
+            converted directly into the file, mapping at most about
+            `slab_budget` bytes of it per conversion task (but always at least
+            one row, e.g. one z slice of a volume); the arrays are then views
+            of the saved file. (With compression, the payload is converted
+            and compressed in memory first.) Returns the path of the files,
+            without extension.
+        '''
+        path = os.path.join(media_dir, DATASET_FOLDER, *DataPath.get_path_parts(self.label))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if self._pending is not None and self._compression is None:
+            with open(path + '.bin', 'wb') as bin_file:
+                bin_file.truncate(self.bufsize)
+            # Converting is saving here, so it is all one 'save' stage
+            self._convert_pending_to_file(path + '.bin', slab_budget, stage='save')
+        else:
+            buffers = self.get_buffers()
+            with self._stage('save', self.bufsize):
+                if self.bufsize == 0:
+                    # np.memmap cannot map an empty file
+                    open(path + '.bin', 'wb').close()
+                else:
+                    bin_file = np.memmap(path + '.bin', dtype=np.uint8, mode='w+', shape=(self.bufsize,))
+                    offset = 0
+                    for buf in buffers:
+                        bin_file[offset:offset + len(buf)] = np.frombuffer(buf, dtype=np.uint8)
+                        offset += len(buf)
+                    bin_file.flush()
+
+        # The header goes last, since deferred conversion fills in the ranges
+        with open(path + '.json', 'w') as json_file:
+            json.dump(self.json_header, json_file)
+        return path
+
+def split_by_topology(vtk_data, label, **kwargs):
+    '''
+        Split an unstructured grid or polydata with mixed cell types into one
+        ABRDataFormat per UnityMeshTopology, so each part arrives in Unity
+        with the right topology. Each part only carries the points (and point
+        data) its cells use, and is labeled with a sibling KeyData name, e.g.
+        `Org/Dataset/KeyData/Name_Triangles`. Cells whose type has no Unity
+        topology are dropped with a warning.
+
+        Data with a single topology is returned unchanged under `label`.
+        Keyword arguments are passed on to each ABRDataFormat.
+    '''
+    if not (vtk_data.IsA('vtkUnstructuredGrid') or vtk_data.IsA('vtkPolyData')):
+        return [ABRDataFormat(vtk_data, label, **kwargs)]
+
+    # Map every VTK cell type to its topology (or -1) with a lookup table
+    topology_lookup = np.full(256, -1, dtype=np.int16)
+    for cell_type, topology in VTK_TO_TOPOLOGY.items():
+        topology_lookup[cell_type] = int(topology)
+    cell_types = get_cell_types(vtk_data)
+    cell_topologies = topology_lookup[cell_types]
+
+    unknown = np.count_nonzero(cell_topologies < 0)
+    if unknown > 0:
+        print('WARNING (label {}): dropping {} cells with no Unity topology'.format(label, unknown))
+
+    topology_counts = np.bincount(cell_topologies + 1)
+    topologies = [UnityMeshTopology(t - 1) for t in np.flatnonzero(topology_counts) if t > 0]
+    if len(topologies) == 1 and unknown == 0:
+        return [ABRDataFormat(vtk_data, label, **kwargs)]
+
+    offsets, connectivity = get_cell_arrays(vtk_data)
+    counts = np.diff(offsets)
+    points = numpy_support.vtk_to_numpy(vtk_data.GetPoints().GetData())
+    point_data = vtk_data.GetPointData()
+    array_names = [point_data.GetArrayName(i) for i in range(point_data.GetNumberOfArrays()) if point_data.GetArray(i) is not None]
+    num_points = vtk_data.GetNumberOfPoints()
+
+    parts = []
+    for topology in topologies:
+        cell_mask = cell_topologies == int(topology)
+        part_counts = counts[cell_mask]
+        part_connectivity = connectivity[np.repeat(cell_mask, counts)]
+
+        # Only keep the points this part uses, and renumber them 0..n-1
+        used = np.zeros(num_points, dtype=bool)
+        used[part_connectivity] = True
+        used_ids = np.flatnonzero(used)
+        remap = np.zeros(num_points, dtype=np.int64)
+        remap[used_ids] = np.arange(used_ids.size)
+
+        part_offsets = np.zeros(part_counts.size + 1, dtype=np.int64)
+        np.cumsum(part_counts, out=part_offsets[1:])
+        cells = vtk.vtkCellArray()
+        cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(part_offsets, deep=1),
+            numpy_support.numpy_to_vtkIdTypeArray(remap[part_connectivity], deep=1))
+
+        part = vtk.vtkUnstructuredGrid()
+        part_points = vtk.vtkPoints()
+        part_points.SetData(numpy_support.numpy_to_vtk(points[used_ids], deep=1))
+        part.SetPoints(part_points)
+        part_types = numpy_support.numpy_to_vtk(cell_types[cell_mask], deep=1, array_type=vtk.VTK_UNSIGNED_CHAR)
+        part.SetCells(part_types, cells)
+
+        for name in _select_array_names(array_names, kwargs.get('include'), kwargs.get('exclude')):
+            arr = point_data.GetArray(name)
+            part_arr = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(arr)[used_ids], deep=1)
+            part_arr.SetName(arr.GetName())
+            part.GetPointData().AddArray(part_arr)
+
+        part_label = DataPath.make_path(DataPath.get_organization(label), DataPath.get_dataset(label),
+            DataPath.DataPathType.KeyData, '{}_{}'.format(DataPath.get_name(label), topology.name))
+        parts.append(ABRDataFormat(part, part_label, **kwargs))
+    return parts
@@ -0,0 +1,207 @@
+# ABRDataReader.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Reads back the .json/.bin pairs that ABRDataFormat writes, without loading
+# the payload: every array is a view of one read-only np.memmap of the .bin
+
+import json
+import os
+
+import numpy as np
+
+from .ABRDataFormat import PayloadWriter, DATASET_FOLDER, INDEX_FORMATS
+from .Conversion import SCALAR_ENCODINGS, dequantize
+from .Compression import decompress_payload
+from .Filters import reverse_filters
+from .DataPath import DataPath
+
+def get_sections(json_header):
+    '''
+        List the sections of the binary payload described by `json_header`
+        as (attribute, dtype, shape) tuples, in the order
+        `RawDataset.BinaryData.Decode` reads them: vertices (not for
+        image data), cell indices, each scalar array, each vector array, and
+        with the 'offsets' index layout, cell offsets and counts.
+    '''
+    num_points = json_header['num_points']
+    num_cells = json_header['num_cells']
+    sections = []
+    # Unstructured volumes (e.g. tetrahedra) have vertices too
+    if json_header.get('dimensions') is None:
+        sections.append(('vertex_array', 'f4', (num_points, 3)))
+    index_dtype = INDEX_FORMATS[json_header.get('indexFormat', 'int32')]
+    sections.append(('cells', index_dtype, (json_header['num_cell_indices'],)))
+    encodings = json_header.get('scalarEncodings', ['f32'] * len(json_header['scalarArrayNames']))
+    sections.extend(('scalar_arrays', SCALAR_ENCODINGS[encoding], (num_points,)) for encoding in encodings)
+    sections.extend(('vector_arrays', 'f4', (num_points, 3)) for _ in json_header['vectorArrayNames'])
+    if json_header.get('indexLayout', 'legacy') == 'offsets' and not json_header.get('implicitPointIndices', False):
+        sections.append(('cell_index_offsets', 'i4', (num_cells,)))
+        sections.append(('cell_index_counts', 'i4', (num_cells,)))
+    return sections
+
+def get_section_names(json_header):
+    '''
+        Names of the sections listed by `get_sections`: 'vertices', 'cells',
+        'scalars/<array name>', 'vectors/<array name>', 'cell_offsets' and
+        'cell_counts'.
+    '''
+    names = {'vertex_array': 'vertices', 'cells': 'cells', 'cell_index_offsets': 'cell_offsets', 'cell_index_counts': 'cell_counts'}
+    scalar_names = iter(json_header['scalarArrayNames'])
+    vector_names = iter(json_header['vectorArrayNames'])
+    result = []
+    for attribute, _, _ in get_sections(json_header):
+        if attribute == 'scalar_arrays':
+            result.append('scalars/' + next(scalar_names))
+        elif attribute == 'vector_arrays':
+            result.append('vectors/' + next(vector_names))
+        else:
+            result.append(names[attribute])
+    return result
+
+def get_payload_size(json_header):
+    # Size of the raw (uncompressed) payload
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in get_sections(json_header))
+
+def decode_payload(json_header, data, workers=1):
+    '''
+        Decompress the payload `data` as described by the `compression` in
+        `json_header`, on `workers` threads, and reverse its filters.
+        Returns the raw payload as a uint8 array.
+    '''
+    compression = json_header['compression']
+    sections = get_sections(json_header)
+    arena = decompress_payload(data, compression['codec'], workers)
+    if len(arena) != get_payload_size(json_header):
+        raise ValueError('Payload decompressed to {} bytes, but its header describes {}'.format(len(arena), get_payload_size(json_header)))
+    offset = 0
+    for (_, dtype, shape), filters in zip(sections, compression.get('filters', [[]] * len(sections))):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if filters:
+            components = shape[1] if len(shape) > 1 else 1
+            reverse_filters(arena[offset:offset + nbytes], dtype, filters, components)
+        offset += nbytes
+    return arena
+
+class ABRDataReader(PayloadWriter):
+    '''
+        Opens a dataset saved by `ABRDataFormat.save()` (or Unity), given its
+        path with or without the .json/.bin extension, and exposes the same
+        attributes as ABRDataFormat: `json_header`, `bufsize`,
+        `vertex_array` (None for image data), `cells`, `scalar_arrays`,
+        `vector_arrays`, and `cell_index_offsets`/`cell_index_counts` with
+        the 'offsets' index layout.
+
+        The arrays are zero-copy views of a read-only memory map of the .bin,
+        so opening a dataset reads only the header, and reading an array
+        only touches that array's pages. A reader can be sent to Unity like
+        any ABRDataFormat.
+
+        A compressed payload is decompressed into memory instead, on
+        `workers` threads, its sections are unfiltered, and `compression`
+        is removed from the header.
+    '''
+    def __init__(self, path, label=None, workers=1):
+        path, extension = os.path.splitext(path)
+        if extension not in ('.json', '.bin'):
+            path = path + extension
+        with open(path + '.json') as json_file:
+            json_header = json.load(json_file)
+
+        bufsize = get_payload_size(json_header)
+        compression = json_header.get('compression')
+        file_size = os.path.getsize(path + '.bin') if compression is None else compression['rawSize']
+        if file_size != bufsize:
+            raise ValueError('{}.bin holds {} bytes, but its header describes {}'.format(path, file_size, bufsize))
+
+        if compression is not None:
+            with open(path + '.bin', 'rb') as bin_file:
+                arena = decode_payload(json_header, bin_file.read(), workers)
+        elif bufsize > 0:
+            # np.memmap cannot map an empty file
+            arena = np.memmap(path + '.bin', dtype=np.uint8, mode='r', shape=(bufsize,))
+        else:
+            arena = np.empty(0, dtype=np.uint8)
+        self._open(json_header, arena, label)
+        self.path = path
+
+    @classmethod
+    def from_payload(cls, json_header, payload, label=None, workers=1):
+        '''
+            Wrap a payload received with `json_header` (e.g. from a socket)
+            without copying it, decoding it first if it is compressed.
+            `path` is None.
+        '''
+        json_header = dict(json_header)
+        if 'compression' in json_header:
+            arena = decode_payload(json_header, payload, workers)
+        else:
+            arena = np.frombuffer(payload, dtype=np.uint8)
+            if len(arena) != get_payload_size(json_header):
+                raise ValueError('Payload holds {} bytes, but its header describes {}'.format(len(arena), get_payload_size(json_header)))
+        reader = cls.__new__(cls)
+        reader._open(json_header, arena, label)
+        reader.path = None
+        return reader
+
+    def _open(self, json_header, arena, label):
+        # Make the attributes views of the raw payload in `arena`
+        json_header.pop('compression', None)
+        self.json_header = json_header
+        self.label = label
+        self.arena = arena
+        self.bufsize = len(arena)
+        self.vertex_array = None
+        self.cells = None
+        self.cell_index_offsets = None
+        self.cell_index_counts = None
+        self.scalar_arrays = []
+        self.vector_arrays = []
+
+        offset = 0
+        for attribute, dtype, shape in get_sections(json_header):
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            view = self.arena[offset:offset + nbytes].view(dtype).reshape(shape)
+            offset += nbytes
+            if attribute in ('scalar_arrays', 'vector_arrays'):
+                getattr(self, attribute).append(view)
+            else:
+                setattr(self, attribute, view)
+
+    @classmethod
+    def from_media(cls, media_dir, label, workers=1):
+        '''
+            Open the dataset `label` (e.g. `Org/Dataset/KeyData/Name`) in an
+            ABR media directory, where `save()` and `MediaDataLoader` keep it.
+        '''
+        return cls(os.path.join(media_dir, DATASET_FOLDER, *DataPath.get_path_parts(label)), label, workers)
+
+    def get_scalar_array(self, name):
+        # As stored, which may be encoded (see get_scalar_values)
+        return self.scalar_arrays[self.json_header['scalarArrayNames'].index(name)]
+
+    def get_scalar_values(self, name):
+        '''
+            A scalar array as float32 values, decoded (into a copy) if it
+            was stored with a `scalarEncodings` encoding other than f32.
+        '''
+        i = self.json_header['scalarArrayNames'].index(name)
+        encoding = self.json_header.get('scalarEncodings', ['f32'] * (i + 1))[i]
+        if encoding == 'f32':
+            return self.scalar_arrays[i]
+        return dequantize(self.scalar_arrays[i], encoding, self.json_header['scalarMins'][i], self.json_header['scalarMaxes'][i])
+
+    def get_vector_array(self, name):
+        return self.vector_arrays[self.json_header['vectorArrayNames'].index(name)]
+
+    def get_volume(self, name):
+        '''
+            A volume scalar array in its (z, y, x) layout; z is flipped
+            relative to the VTK data, as Unity expects.
+        '''
+        dims = self.json_header['dimensions']
+        return self.get_scalar_array(name).reshape(dims[2], dims[1], dims[0])
+
+    def get_buffers(self):
+        return [memoryview(self.arena)]
@@ -0,0 +1,222 @@
+# BatchConvert.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Converts VTK files on disk into an ABR media tree, outside of ParaView.
+# Run from the EasyParaViewToABR folder, e.g.:
+#
+#   python -m abr_data_format.BatchConvert 'archive/*.vtu' \
+#       --media ~/ABR/media --label 'TACC/Ocean/KeyData/{stem}'
+#
+# Inputs are converted on a pool of processes. A manifest in the media
+# folder remembers each input's modification time, size and content hash, so
+# running the same command again only converts what changed.
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import vtk
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .ABRDataFormat import ABRDataFormat, split_by_topology, SLAB_BUDGET, DATASET_FOLDER
+from .DataPath import DataPath
+
+# Manifest of converted inputs, kept in the media folder
+MANIFEST_NAME = '.abr_batch_convert.json'
+
+# File extensions picked up when an input is a directory
+VTK_EXTENSIONS = ('.vtk', '.vtu', '.vtp', '.vti')
+
+def find_inputs(patterns):
+    '''
+        Expand directories (searched recursively for VTK files) and glob
+        patterns into a sorted list of unique absolute paths.
+    '''
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.update(os.path.join(root, f) for f in files if f.lower().endswith(VTK_EXTENSIONS))
+        else:
+            paths.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    return sorted(os.path.abspath(p) for p in paths)
+
+def make_label(template, path):
+    '''
+        Fill in a DataPath label template for the input at `path`. Available
+        fields are {stem} (the file name without extension), {name} (the
+        file name) and {parent} (the name of the folder it is in), e.g.
+        `TACC/Ocean/KeyData/{stem}`.
+    '''
+    name = os.path.basename(path)
+    label = template.format(stem=os.path.splitext(name)[0], name=name, parent=os.path.basename(os.path.dirname(path)))
+    if len(DataPath.get_path_parts(label)) < 4:
+        raise ValueError('Label {} is not of the form Organization/Dataset/KeyData/Name'.format(label))
+    return label
+
+def hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_vtk_file(path):
+    if path.lower().endswith('.vtk'):
+        reader = vtk.vtkDataSetReader()
+    else:
+        reader = vtk.vtkXMLGenericDataObjectReader()
+    reader.SetFileName(path)
+    reader.Update()
+    vtk_data = reader.GetOutput()
+    if vtk_data is None:
+        raise ValueError('Could not read {}'.format(path))
+    return vtk_data
+
+def convert_file(path, label, media_dir, options, split=False, slab_budget=SLAB_BUDGET, previous_hash=None):
+    '''
+        Convert one input file and save it into `media_dir`. Runs in a worker
+        process. If the content hash equals `previous_hash`, nothing is
+        converted. Returns a dict describing what was done.
+    '''
+    start = time.perf_counter()
+    content_hash = hash_file(path)
+    result = {'path': path, 'hash': content_hash, 'labels': [], 'converted': False}
+    if content_hash != previous_hash:
+        vtk_data = read_vtk_file(path)
+        if split:
+            datasets = split_by_topology(vtk_data, label, deferred=True, **options)
+        else:
+            datasets = [ABRDataFormat(vtk_data, label, deferred=True, **options)]
+        for dataset in datasets:
+            dataset.save(media_dir, slab_budget)
+            result['labels'].append(dataset.label)
+        result['converted'] = True
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _outputs_exist(media_dir, labels):
+    path = os.path.join(media_dir, DATASET_FOLDER)
+    return all(os.path.exists(os.path.join(path, *DataPath.get_path_parts(label)) + ext) for label in labels for ext in ('.json', '.bin'))
+
+def load_manifest(media_dir):
+    try:
+        with open(os.path.join(media_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(media_dir, manifest):
+    # Write to a temporary file first so an interrupted run keeps the old one
+    path = os.path.join(media_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def batch_convert(inputs, media_dir, label_template, options=None, split=False, slab_budget=SLAB_BUDGET, jobs=None, force=False):
+    '''
+        Convert every input found by `find_inputs(inputs)` into the media
+        tree at `media_dir`, labeling each with `make_label(label_template,
+        path)`. `options` are passed on to each ABRDataFormat; with `split`,
+        mixed topologies are split with `split_by_topology`.
+
+        An input is skipped when its modification time and size match the
+        manifest, or when they do not but its content hash does, as long as
+        its label, the options and the saved files are unchanged. `force`
+        converts everything. Conversions run on `jobs` processes (default:
+        one per CPU). Returns a dict of counts: converted, unchanged,
+        skipped and failed.
+    '''
+    options = options or {}
+    os.makedirs(media_dir, exist_ok=True)
+    manifest = load_manifest(media_dir)
+    settings = json.dumps({'options': options, 'split': split}, sort_keys=True)
+    counts = {'converted': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+
+    paths = find_inputs(inputs)
+    labels = [make_label(label_template, path) for path in paths]
+    if len(set(labels)) < len(labels):
+        raise ValueError('Label template {} gives several inputs the same label'.format(label_template))
+
+    jobs_to_run = []
+    for path, label in zip(paths, labels):
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        up_to_date = (not force and entry is not None and entry['label'] == label and entry['settings'] == settings
+            and _outputs_exist(media_dir, entry['labels']))
+        if up_to_date and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            counts['skipped'] += 1
+            continue
+        jobs_to_run.append((path, label, stat, entry['hash'] if up_to_date else None))
+
+    try:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = {pool.submit(convert_file, path, label, media_dir, options, split, slab_budget, previous_hash): (path, label, stat)
+                for path, label, stat, previous_hash in jobs_to_run}
+            for future in as_completed(futures):
+                path, label, stat = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print('FAILED {}: {}'.format(path, e))
+                    manifest.pop(path, None)
+                    counts['failed'] += 1
+                    continue
+
+                if result['converted']:
+                    print('{} -> {} ({:.2f} s)'.format(path, ', '.join(result['labels']), result['seconds']))
+                    counts['converted'] += 1
+                    saved_labels = result['labels']
+                else:
+                    counts['unchanged'] += 1
+                    saved_labels = manifest[path]['labels']
+                manifest[path] = {
+                    'label': label,
+                    'labels': saved_labels,
+                    'settings': settings,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'hash': result['hash'],
+                }
+    finally:
+        save_manifest(media_dir, manifest)
+    return counts
+
+def _split_patterns(value):
+    return [p.strip() for p in value.split(',') if p.strip()] or None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert VTK files into an ABR media folder')
+    parser.add_argument('inputs', nargs='+', help='VTK files, glob patterns or directories')
+    parser.add_argument('--media', required=True, help='ABR media folder to write datasets into')
+    parser.add_argument('--label', required=True, help='DataPath label template, e.g. Org/Dataset/KeyData/{stem}')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='Convert inputs even if they have not changed')
+    parser.add_argument('--split', action='store_true', help='Split mixed topologies into one dataset each')
+    parser.add_argument('--include', type=_split_patterns, default=None, help='Comma-separated globs of point arrays to convert')
+    parser.add_argument('--exclude', type=_split_patterns, default=None, help='Comma-separated globs of point arrays to leave out')
+    parser.add_argument('--kernel', default='fused', choices=['reference', 'fused'])
+    parser.add_argument('--workers', type=int, default=1, help='Threads per conversion')
+    parser.add_argument('--index-layout', default='legacy', choices=['legacy', 'offsets'])
+    parser.add_argument('--index-format', default='int32', choices=['int32', 'uint16', 'auto'])
+    parser.add_argument('--scalar-encoding', default='f32', choices=['f32', 'f16', 'u16norm', 'u8norm'])
+    parser.add_argument('--compression', default=None, choices=['zlib', 'lzma'], help='Compress the saved payloads (not read by Unity yet)')
+    parser.add_argument('--compression-level', type=int, default=None)
+    parser.add_argument('--compression-filters', default=None, choices=['auto'], help='Precondition sections before compressing them')
+    parser.add_argument('--slab-budget', type=int, default=SLAB_BUDGET, help='Most bytes of output mapped at once per conversion task')
+
+    args = parser.parse_args(argv)
+    options = dict(include=args.include, exclude=args.exclude, kernel=args.kernel, workers=args.workers, index_layout=args.index_layout,
+        index_format=args.index_format, scalar_encoding=args.scalar_encoding, compression=args.compression, compression_level=args.compression_level,
+        compression_filters=args.compression_filters)
+    counts = batch_convert(args.inputs, args.media, args.label, options, args.split, args.slab_budget, args.jobs, args.force)
+    print('{converted} converted, {unchanged} unchanged, {skipped} skipped, {failed} failed'.format(**counts))
+    return 1 if counts['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
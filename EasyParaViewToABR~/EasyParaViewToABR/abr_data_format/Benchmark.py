@@ -0,0 +1,820 @@
+# Benchmark.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Benchmarks for the abr_data_format conversion paths. Run from the
+# EasyParaViewToABR folder, e.g.:
+#
+#   python -m abr_data_format.Benchmark kernels --sizes 1e6 1e7 1e8
+#   python -m abr_data_format.Benchmark formats --output results.json
+#   python -m abr_data_format.Benchmark compare baseline.json results.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where peaks are only traced by tracemalloc
+    resource = None
+
+from .ABRDataFormat import ABRDataFormat, cell_type_histogram
+from .Conversion import CONVERSION_KERNELS
+from .Compression import compress_buffers, decompress_payload
+from .Filters import apply_filters, reverse_filters
+from .Receiver import Receiver
+from .Sender import ConnectionPool, SendQueue, open_connection, read_string, request_update, send_message, write_message, write_string
+from .Updates import make_attribute_update, BrickDiff
+
+# Result fields that are measurements; all other fields identify a result
+MEASUREMENTS = ('seconds', 'input_gb_per_s', 'speedup_vs_legacy', 'elements_per_s', 'payload_mb_per_s', 'peak_mb',
+    'payload_percent', 'diff_seconds', 'p99_seconds', 'blocked_seconds', 'sent', 'dropped', 'last_latency',
+    'ratio', 'compress_mb_per_s', 'decompress_mb_per_s', 'filter_mb_per_s', 'unfilter_mb_per_s',
+    'payload_bytes', 'index_bytes_saved', 'payload_saved_percent')
+
+def _best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _legacy_convert(src):
+    # What ABRDataFormat has always done for a scalar array
+    arr = np.nan_to_num(src).astype('f4')
+    return arr, float(np.amin(arr)), float(np.max(arr))
+
+def benchmark_kernels(sizes, repeat=3, nan_fraction=0.001):
+    '''
+        Time the scalar conversion kernels on float64 arrays of each size in
+        `sizes`. 'legacy' is the original copying path, the others write into
+        a preallocated float32 output. Returns a list of result dicts.
+    '''
+    results = []
+    for size in sizes:
+        size = int(size)
+        src = np.random.default_rng(0).random(size)
+        src[::max(1, int(1 / nan_fraction))] = np.nan
+        out = np.empty(size, dtype='f4')
+
+        timings = {'legacy': _best_time(lambda: _legacy_convert(src), repeat)}
+        for name, kernel in CONVERSION_KERNELS.items():
+            timings[name] = _best_time(lambda: kernel(src, out), repeat)
+
+        for name, seconds in timings.items():
+            results.append({
+                'benchmark': 'kernels',
+                'kernel': name,
+                'elements': size,
+                'seconds': seconds,
+                'input_gb_per_s': src.nbytes / seconds / 1e9,
+                'speedup_vs_legacy': timings['legacy'] / seconds,
+            })
+        del src, out
+    return results
+
+def _point_data(vtk_data, num_points, nan_fraction=0.001):
+    # One scalar (with a few NaNs) and one 3-vector, as float64 like most
+    # simulation output
+    rng = np.random.default_rng(0)
+    scalar = rng.random(num_points)
+    scalar[::max(1, int(1 / nan_fraction))] = np.nan
+    vector = rng.random((num_points, 3))
+    for name, arr in (('scalar', scalar), ('vector', vector)):
+        vtk_arr = numpy_support.numpy_to_vtk(arr)
+        vtk_arr.SetName(name)
+        vtk_data.GetPointData().AddArray(vtk_arr)
+    return vtk_data
+
+def _cell_array(offsets, connectivity):
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets.astype(np.int64)),
+        numpy_support.numpy_to_vtkIdTypeArray(connectivity.astype(np.int64)))
+    return cells
+
+def _with_points(vtk_data, num_points):
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.random.default_rng(1).random((num_points, 3))))
+    vtk_data.SetPoints(points)
+    return vtk_data
+
+def make_points(num_points):
+    polydata = _with_points(vtk.vtkPolyData(), num_points)
+    polydata.SetVerts(_cell_array(np.arange(num_points + 1), np.arange(num_points)))
+    return polydata
+
+def make_lines(num_points):
+    # Separate segments between pairs of points
+    num_cells = num_points // 2
+    polydata = _with_points(vtk.vtkPolyData(), num_points)
+    polydata.SetLines(_cell_array(np.arange(0, 2 * num_cells + 1, 2), np.arange(2 * num_cells)))
+    return polydata
+
+def make_line_strips(num_points, strip_length=1000):
+    grid = _with_points(vtk.vtkUnstructuredGrid(), num_points)
+    offsets = np.append(np.arange(0, num_points, strip_length), num_points)
+    grid.SetCells(vtk.VTK_POLY_LINE, _cell_array(offsets, np.arange(num_points)))
+    return grid
+
+def _make_surface(num_points, cell_type, cell_size):
+    # As many cells as points, with random corners
+    grid = _with_points(vtk.vtkUnstructuredGrid(), num_points)
+    connectivity = np.random.default_rng(2).integers(0, num_points, cell_size * num_points)
+    grid.SetCells(cell_type, _cell_array(np.arange(0, cell_size * num_points + 1, cell_size), connectivity))
+    return grid
+
+def make_triangles(num_points):
+    return _make_surface(num_points, vtk.VTK_TRIANGLE, 3)
+
+def make_quads(num_points):
+    return _make_surface(num_points, vtk.VTK_QUAD, 4)
+
+def make_volume(num_points):
+    # The closest cube
+    side = max(2, int(round(num_points ** (1 / 3))))
+    image = vtk.vtkImageData()
+    image.SetDimensions(side, side, side)
+    return image
+
+# Synthetic input for each UnityMeshTopology, by number of points
+SYNTHETIC_INPUTS = {
+    'Points': make_points,
+    'Lines': make_lines,
+    'LineStrip': make_line_strips,
+    'Triangles': make_triangles,
+    'Quads': make_quads,
+    'Volume': make_volume,
+}
+
+def make_grid_surface(side, cell_type=vtk.VTK_TRIANGLE):
+    # A side x side grid of points, like one block of a larger surface,
+    # made of quads or of triangles (two per quad)
+    grid = _with_points(vtk.vtkUnstructuredGrid(), side * side)
+    corner = (np.arange(side - 1)[:, None] * side + np.arange(side - 1)[None, :]).reshape(-1)
+    a, b, c, d = corner, corner + 1, corner + side + 1, corner + side
+    if cell_type == vtk.VTK_QUAD:
+        connectivity = np.stack([a, b, c, d], axis=1)
+    else:
+        connectivity = np.stack([a, b, c, a, c, d], axis=1)
+    cell_size = 4 if cell_type == vtk.VTK_QUAD else 3
+    connectivity = connectivity.reshape(-1)
+    grid.SetCells(cell_type, _cell_array(np.arange(0, connectivity.size + 1, cell_size), connectivity))
+    return grid
+
+def make_smooth_surface(side):
+    # A side x side grid of triangles over a wavy height field, with a
+    # smooth scalar, like a block of simulation output
+    grid = make_grid_surface(side)
+    x, y = np.meshgrid(np.linspace(0, 1, side), np.linspace(0, 1, side))
+    z = 0.1 * np.sin(6 * x) * np.cos(4 * y)
+    grid.GetPoints().SetData(numpy_support.numpy_to_vtk(np.stack([x, y, z], axis=-1).reshape(-1, 3)))
+    scalar = numpy_support.numpy_to_vtk((np.exp(-((x - 0.5) ** 2 + (y - 0.3) ** 2) * 8) * 300 + 273).reshape(-1))
+    scalar.SetName('temperature')
+    grid.GetPointData().AddArray(scalar)
+    return grid
+
+def make_smooth_volume(side):
+    # A side^3 volume holding a smooth field
+    image = vtk.vtkImageData()
+    image.SetDimensions(side, side, side)
+    z, y, x = np.meshgrid(*[np.linspace(0, 1, side)] * 3, indexing='ij', sparse=True)
+    scalar = numpy_support.numpy_to_vtk((np.sin(5 * x) * np.cos(3 * y) + z * z).reshape(-1))
+    scalar.SetName('density')
+    image.GetPointData().AddArray(scalar)
+    return image
+
+def benchmark_filters(inputs=None, side=256, codecs=('zlib:1', 'lzma:1'), repeat=3,
+        filter_sets=((), ('shuffle',), ('delta',), ('xor',), ('delta', 'shuffle'), ('xor', 'shuffle'))):
+    '''
+        Compress the exported `vertex_array` and each of the `scalar_arrays`
+        of each VTK file in `inputs` (default: a smooth `side` x `side`
+        surface and a smooth volume of `side / 2` points per side) after each set of filters in
+        `filter_sets`, with each codec ('codec' or 'codec:level'). Returns a
+        list of result dicts with the compression ratio and the filter,
+        compress (including filtering) and unfilter throughputs, in MB/s
+        of raw section.
+    '''
+    if inputs:
+        from .BatchConvert import read_vtk_file
+        datasets = {os.path.basename(path): lambda path=path: read_vtk_file(path) for path in inputs}
+    else:
+        datasets = {'smooth_surface': lambda: make_smooth_surface(side), 'smooth_volume': lambda: make_smooth_volume(side // 2)}
+    results = []
+    for dataset, read in datasets.items():
+        formatted = ABRDataFormat(read(), 'Benchmark/Filters/KeyData/' + dataset, arena=True)
+        sections = {'vertex_array': (formatted.vertex_array, 3)} if formatted.vertex_array is not None else {}
+        for name, arr in zip(formatted.json_header['scalarArrayNames'], formatted.scalar_arrays):
+            sections['scalar_arrays/' + name] = (arr, 1)
+        for section, (arr, components) in sections.items():
+            for filters in filter_sets:
+                filtered = apply_filters(arr, filters, components)
+                filter_seconds = _best_time(lambda: apply_filters(arr, filters, components), repeat)
+                unfilter_seconds = _best_time(lambda: reverse_filters(filtered.copy(), arr.dtype, filters, components), repeat)
+                for codec in codecs:
+                    name, _, level = codec.partition(':')
+                    level = int(level) if level else None
+                    compressed = sum(len(buf) for buf in compress_buffers([filtered], name, level))
+                    compress_seconds = _best_time(lambda: compress_buffers([apply_filters(arr, filters, components)], name, level), repeat)
+                    results.append({
+                        'benchmark': 'filters',
+                        'dataset': dataset,
+                        'section': section,
+                        'filters': '+'.join(filters) or 'none',
+                        'codec': codec,
+                        'ratio': arr.nbytes / compressed,
+                        'filter_mb_per_s': arr.nbytes / filter_seconds / 1e6,
+                        'compress_mb_per_s': arr.nbytes / compress_seconds / 1e6,
+                        'unfilter_mb_per_s': arr.nbytes / unfilter_seconds / 1e6,
+                    })
+        del formatted
+    return results
+
+def benchmark_index_bytes(sides=(32, 64, 128, 256, 512)):
+    '''
+        Compare the payload sizes of int32 and automatically chosen
+        (`index_format='auto'`) cell indices, in both index layouts, for
+        grid-shaped triangle and quad surface blocks and for line segments
+        and points with the same numbers of points. Meshes with more than
+        65536 points keep int32 indices. Returns a list of result dicts.
+    '''
+    meshes = {
+        'triangles': lambda side: make_grid_surface(side, vtk.VTK_TRIANGLE),
+        'quads': lambda side: make_grid_surface(side, vtk.VTK_QUAD),
+        'lines': lambda side: make_lines(side * side),
+        'points': lambda side: make_points(side * side),
+    }
+    results = []
+    for mesh, make in meshes.items():
+        for side in sides:
+            vtk_data = _point_data(make(side), side * side)
+            for index_layout in ('legacy', 'offsets'):
+                int32 = ABRDataFormat(vtk_data, 'Benchmark/Synthetic/KeyData/' + mesh, deferred=True, index_layout=index_layout)
+                auto = ABRDataFormat(vtk_data, 'Benchmark/Synthetic/KeyData/' + mesh, deferred=True, index_layout=index_layout, index_format='auto')
+                results.append({
+                    'benchmark': 'indices',
+                    'mesh': mesh,
+                    'elements': side * side,
+                    'index_layout': index_layout,
+                    'index_format': auto.index_format,
+                    'payload_bytes': auto.bufsize,
+                    'index_bytes_saved': int32.bufsize - auto.bufsize,
+                    'payload_saved_percent': 100.0 * (int32.bufsize - auto.bufsize) / int32.bufsize,
+                })
+    return results
+
+def benchmark_compression(size, topologies=('Triangles', 'Volume'), codecs=('zlib:1', 'zlib:6', 'lzma:1'),
+        chunk_sizes=(1 << 16, 1 << 18, 1 << 20, 1 << 22), workers=(1, 4), repeat=3):
+    '''
+        Compress the exported payload of synthetic data of each topology
+        (with `size` points) with each codec (given as 'codec' or
+        'codec:level') split into chunks of each of `chunk_sizes` bytes,
+        on each number of `workers` threads, and decompress it again.
+        Returns a list of result dicts with the compression ratio and the
+        compression and decompression throughputs, in MB/s of raw payload.
+    '''
+    results = []
+    for topology in topologies:
+        vtk_data = SYNTHETIC_INPUTS[topology](int(size))
+        _point_data(vtk_data, vtk_data.GetNumberOfPoints())
+        buffers = ABRDataFormat(vtk_data, 'Benchmark/Synthetic/KeyData/' + topology, arena=True).get_buffers()
+        raw_size = sum(len(buf) for buf in buffers)
+        for codec in codecs:
+            name, _, level = codec.partition(':')
+            level = int(level) if level else None
+            for chunk_size in chunk_sizes:
+                for num_workers in workers:
+                    compressed = compress_buffers(buffers, name, level, chunk_size, num_workers)
+                    payload = b''.join(compressed)
+                    compress_seconds = _best_time(lambda: compress_buffers(buffers, name, level, chunk_size, num_workers), repeat)
+                    decompress_seconds = _best_time(lambda: decompress_payload(payload, name, num_workers), repeat)
+                    results.append({
+                        'benchmark': 'compression',
+                        'topology': topology,
+                        'elements': int(size),
+                        'codec': codec,
+                        'chunk_size': chunk_size,
+                        'workers': num_workers,
+                        'ratio': raw_size / len(payload),
+                        'compress_mb_per_s': raw_size / compress_seconds / 1e6,
+                        'decompress_mb_per_s': raw_size / decompress_seconds / 1e6,
+                    })
+        del vtk_data, buffers
+    return results
+
+def benchmark_updates(sizes, topologies=('Triangles',), timesteps=10, num_scalars=4):
+    '''
+        Send a time series of synthetic data of each topology and number of
+        points in `sizes`, with `num_scalars` scalar arrays of which one
+        changes per timestep, to a stand-in Receiver over loopback: once as
+        full datasets, once as attribute updates carrying the changed
+        array. Returns a list of result dicts with the payload bytes and
+        the median latency (send until ack) per timestep of each.
+    '''
+    results = []
+    with Receiver() as receiver:
+        host, port = receiver.address
+        for topology in topologies:
+            for size in sizes:
+                vtk_data = SYNTHETIC_INPUTS[topology](int(size))
+                num_points = vtk_data.GetNumberOfPoints()
+                label = 'Benchmark/Updates/KeyData/' + topology
+                steps = {'full': [], 'attributes': []}
+                for step in range(timesteps + 1):
+                    for i in range(num_scalars):
+                        arr = numpy_support.numpy_to_vtk(np.sin(np.linspace(0, 10, num_points) + (step if i == 0 else 0)))
+                        arr.SetName('scalar{}'.format(i))
+                        vtk_data.GetPointData().AddArray(arr)
+                    formatted = ABRDataFormat(vtk_data, label)
+                    for kind in steps:
+                        if kind == 'full' or step == 0:
+                            message = formatted
+                        else:
+                            message = make_attribute_update(formatted, scalars=['scalar0'], vectors=[])
+                        start = time.perf_counter()
+                        if send_message(host, port, message) != 'ok':
+                            raise ValueError('Receiver did not apply the {} message'.format(kind))
+                        if step > 0:
+                            steps[kind].append((time.perf_counter() - start, message.bufsize))
+                for kind, sends in steps.items():
+                    results.append({
+                        'benchmark': 'updates',
+                        'topology': topology,
+                        'elements': num_points,
+                        'message': kind,
+                        'seconds': float(np.median([seconds for seconds, _ in sends])),
+                        'payload_bytes': sends[-1][1],
+                    })
+                del vtk_data, formatted
+    return results
+
+def benchmark_bricks(sides, brick_sizes=(16, 32, 64), tolerances=(None, 1e-3), timesteps=10, radius=0.1):
+    '''
+        Send a volume of `side`^3 points per side in `sides`, in which a
+        smooth blob of `radius` (a fraction of the side) moves across a
+        constant background, to a stand-in Receiver over loopback as brick
+        updates, for each brick size and tolerance. Returns a list of result
+        dicts with the median payload per timestep as a percentage of the
+        whole dataset, the time to find the changed bricks, and the latency
+        from send until ack.
+    '''
+    results = []
+    with Receiver() as receiver:
+        host, port = receiver.address
+        for side in sides:
+            image = vtk.vtkImageData()
+            image.SetDimensions(side, side, side)
+            z, y, x = np.meshgrid(*[np.linspace(0, 1, side)] * 3, indexing='ij', sparse=True)
+            label = 'Benchmark/Bricks/KeyData/volume'
+            for brick_size in brick_sizes:
+                for tolerance in tolerances:
+                    diff = BrickDiff(brick_size, tolerance)
+                    steps = []
+                    for step in range(timesteps + 1):
+                        center = 0.2 + 0.6 * step / timesteps
+                        blob = np.maximum(0, 1 - ((x - center) ** 2 + (y - 0.5) ** 2 + (z - 0.5) ** 2) / radius ** 2)
+                        arr = numpy_support.numpy_to_vtk(blob.reshape(-1))
+                        arr.SetName('blob')
+                        image.GetPointData().AddArray(arr)
+                        formatted = ABRDataFormat(image, label)
+                        start = time.perf_counter()
+                        message, state = diff.make_update(formatted)
+                        diff_seconds = time.perf_counter() - start
+                        if send_message(host, port, message) != 'ok':
+                            raise ValueError('Receiver did not apply the brick update')
+                        diff.update(label, state)
+                        if step > 0:
+                            steps.append((100.0 * message.bufsize / formatted.bufsize, diff_seconds, time.perf_counter() - start - diff_seconds))
+                    results.append({
+                        'benchmark': 'bricks',
+                        'elements': side ** 3,
+                        'brick_size': brick_size,
+                        'tolerance': tolerance,
+                        'payload_percent': float(np.median([percent for percent, _, _ in steps])),
+                        'diff_seconds': float(np.median([seconds for _, seconds, _ in steps])),
+                        'seconds': float(np.median([seconds for _, _, seconds in steps])),
+                    })
+            del image
+    return results
+
+def _request_update_once(host, port):
+    with open_connection(host, port) as sock:
+        return request_update(sock)
+
+def benchmark_latency(sizes, repeat=200):
+    '''
+        Latency (send until ack) of small messages to a stand-in Receiver over
+        loopback: attribute updates of one scalar array of each number of
+        points in `sizes`, and re-render requests as sent after each render.
+        Each is sent `repeat` times on a new connection per message, as the
+        plugin used to, and through a ConnectionPool. Returns a list of result
+        dicts with the median and 99th percentile latency of each.
+    '''
+    results = []
+    with Receiver() as receiver:
+        host, port = receiver.address
+        pool = ConnectionPool()
+        sends = {
+            'new connection': lambda message: send_message(host, port, message),
+            'pooled': lambda message: pool.send(host, port, message),
+        }
+        updates = {
+            'new connection': lambda: _request_update_once(host, port),
+            'pooled': lambda: pool.send_update(host, port),
+        }
+        cases = []
+        for size in sizes:
+            vtk_data = _point_data(make_points(int(size)), int(size))
+            label = 'Benchmark/Latency/KeyData/points{}'.format(int(size))
+            formatted = ABRDataFormat(vtk_data, label)
+            send_message(host, port, formatted)
+            message = make_attribute_update(formatted, vectors=[])
+            for connection, send in sends.items():
+                cases.append(({'message': 'attributes', 'elements': formatted.json_header['num_points'],
+                    'payload_bytes': message.bufsize, 'connection': connection}, lambda send=send, message=message: send(message)))
+        for connection, update in updates.items():
+            cases.append(({'message': 'update', 'elements': 0, 'payload_bytes': 0, 'connection': connection}, update))
+
+        for fields, func in cases:
+            func()
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                if func() != 'ok':
+                    raise ValueError('Receiver did not ack the {} message'.format(fields['message']))
+                seconds.append(time.perf_counter() - start)
+            results.append(dict(fields, benchmark='latency', seconds=float(np.median(seconds)),
+                p99_seconds=float(np.percentile(seconds, 99))))
+        pool.close()
+    return results
+
+def _legacy_send(sock, message):
+    # How the plugin used to send: a copy of each section by tobytes(), sent
+    # in a loop that copies what is left of it after each partial send
+    def snd(data):
+        offset = 0
+        while offset < len(data):
+            offset += sock.send(data[offset:])
+    write_string(sock, message.label)
+    write_string(sock, json.dumps(message.json_header))
+    sock.sendall(struct.pack('>I', message.bufsize))
+    for buf in message.get_buffers():
+        snd(buf.tobytes())
+
+def _sendall_send(sock, message):
+    # One sendall per section, without copies
+    write_string(sock, message.label)
+    write_string(sock, json.dumps(message.json_header))
+    sock.sendall(struct.pack('>I', message.bufsize))
+    for buf in message.get_buffers():
+        sock.sendall(buf)
+
+SEND_METHODS = {
+    'legacy': _legacy_send,
+    'sendall': _sendall_send,
+    'sendmsg': write_message,
+}
+
+def benchmark_throughput(sizes, topologies=('Triangles', 'Volume'), repeat=3):
+    '''
+        Throughput of sending synthetic data of each topology and number of
+        points in `sizes` to a stand-in Receiver over loopback, with each
+        of SEND_METHODS, from connecting until the ack. Returns a list of
+        result dicts with the best time and payload MB/s of each.
+    '''
+    results = []
+    with Receiver() as receiver:
+        for topology in topologies:
+            for size in sizes:
+                vtk_data = SYNTHETIC_INPUTS[topology](int(size))
+                vtk_data = _point_data(vtk_data, vtk_data.GetNumberOfPoints())
+                formatted = ABRDataFormat(vtk_data, 'Benchmark/Throughput/KeyData/' + topology)
+                formatted.get_buffers()
+                for method, send in SEND_METHODS.items():
+                    def run():
+                        with open_connection(*receiver.address) as sock:
+                            send(sock, formatted)
+                            if read_string(sock) != 'ok':
+                                raise ValueError('Receiver did not ack the message')
+                    seconds = _best_time(run, repeat)
+                    results.append({
+                        'benchmark': 'throughput',
+                        'topology': topology,
+                        'elements': vtk_data.GetNumberOfPoints(),
+                        'method': method,
+                        'payload_bytes': formatted.bufsize,
+                        'seconds': seconds,
+                        'payload_mb_per_s': formatted.bufsize / seconds / 1e6,
+                    })
+                del vtk_data, formatted
+    return results
+
+def benchmark_background(sizes, timesteps=20, interval=0.01):
+    '''
+        Scrub through `timesteps` versions of synthetic triangles of each
+        number of points in `sizes`, one every `interval` seconds, sending
+        each to a stand-in Receiver over loopback: in the caller, and
+        through a SendQueue. Returns a list of result dicts with the median
+        time the caller was blocked per timestep, how many timesteps were
+        sent and dropped, the latency of the last timestep (from its
+        timestep until it was acked) and the total time.
+    '''
+    results = []
+    with Receiver() as receiver:
+        host, port = receiver.address
+        pool = ConnectionPool()
+        for size in sizes:
+            vtk_data = SYNTHETIC_INPUTS['Triangles'](int(size))
+            label = 'Benchmark/Background/KeyData/triangles'
+            steps = []
+            for step in range(timesteps):
+                arr = numpy_support.numpy_to_vtk(np.sin(np.linspace(0, 10, vtk_data.GetNumberOfPoints()) + step))
+                arr.SetName('scalar')
+                vtk_data.GetPointData().AddArray(arr)
+                steps.append(ABRDataFormat(vtk_data, label))
+
+            for mode in ('blocking', 'background'):
+                queue = SendQueue()
+                sends = []
+                def send(formatted):
+                    if pool.send(host, port, formatted) != 'ok':
+                        raise ValueError('Receiver did not apply the dataset')
+                    sends.append(time.perf_counter())
+                blocked = []
+                start = time.perf_counter()
+                for step, formatted in enumerate(steps):
+                    # Wait for the next timestep, as a user scrubbing would
+                    time.sleep(max(0, start + step * interval - time.perf_counter()))
+                    step_start = time.perf_counter()
+                    if mode == 'blocking':
+                        send(formatted)
+                    else:
+                        queue.submit(label, lambda formatted=formatted: send(formatted))
+                    blocked.append(time.perf_counter() - step_start)
+                queue.join()
+                results.append({
+                    'benchmark': 'background',
+                    'elements': int(size),
+                    'mode': mode,
+                    'payload_bytes': steps[0].bufsize,
+                    'blocked_seconds': float(np.median(blocked)),
+                    'sent': len(sends),
+                    'dropped': queue.dropped,
+                    'last_latency': sends[-1] - step_start,
+                    'seconds': sends[-1] - start,
+                })
+            del vtk_data, steps
+        pool.close()
+    return results
+
+def _traced_peak(func):
+    # Peak of Python and NumPy allocations made by func (VTK's own
+    # allocations are not seen); measured apart from the timings, since
+    # tracing slows allocation down
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark_formats(sizes, topologies=None, repeat=3, options=None):
+    '''
+        Time the stages of exporting synthetic data of every topology in
+        `topologies` (default: all of SYNTHETIC_INPUTS) at each number of
+        points in `sizes`. The stages are:
+
+        - histogram: `cell_type_histogram`
+        - construct: `ABRDataFormat(...)` with `options`, which converts
+          the arrays
+        - export: `write_into` a null file
+        - save: a deferred `ABRDataFormat` saved into a media folder
+
+        Returns a list of result dicts with the best time of `repeat` runs,
+        throughput, and the peak memory allocated by the stage.
+    '''
+    options = options or {}
+    results = []
+    media_dir = tempfile.mkdtemp()
+    try:
+        for topology in (topologies or SYNTHETIC_INPUTS):
+            for size in sizes:
+                size = int(size)
+                vtk_data = SYNTHETIC_INPUTS[topology](size)
+                num_points = vtk_data.GetNumberOfPoints()
+                _point_data(vtk_data, num_points)
+                label = 'Benchmark/Synthetic/KeyData/' + topology
+                formatted = ABRDataFormat(vtk_data, label, **options)
+
+                with open(os.devnull, 'wb') as null_file:
+                    stages = {
+                        'histogram': lambda: cell_type_histogram(vtk_data),
+                        'construct': lambda: ABRDataFormat(vtk_data, label, **options),
+                        'export': lambda: formatted.write_into(null_file),
+                        'save': lambda: ABRDataFormat(vtk_data, label, deferred=True, **options).save(media_dir),
+                    }
+                    for stage, func in stages.items():
+                        seconds = _best_time(func, repeat)
+                        results.append({
+                            'benchmark': 'formats',
+                            'topology': topology,
+                            'elements': num_points,
+                            'stage': stage,
+                            'options': json.dumps(options, sort_keys=True),
+                            'seconds': seconds,
+                            'elements_per_s': num_points / seconds,
+                            'payload_mb_per_s': formatted.bufsize / seconds / 1e6,
+                            'peak_mb': _traced_peak(func) / 1e6,
+                        })
+                del vtk_data, formatted
+    finally:
+        shutil.rmtree(media_dir)
+    return results
+
+def _metadata():
+    metadata = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'vtk': vtk.vtkVersion.GetVTKVersion(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    if resource is not None:
+        metadata['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return metadata
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump({'metadata': _metadata(), 'results': results}, f, indent=1)
+
+def _result_key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in MEASUREMENTS))
+
+def compare_results(baseline, current, time_threshold=0.1, memory_threshold=0.1, min_seconds=0.01):
+    '''
+        Compare two lists of results, matched on their non-measurement
+        fields. A result regresses if it is more than `time_threshold`
+        (a fraction) slower than the baseline, ignoring times under
+        `min_seconds` in both, or if its peak memory grew by more than
+        `memory_threshold` and 1 MB. Returns a list of
+        (key, field, baseline value, current value) regressions.
+    '''
+    baseline = {_result_key(r): r for r in baseline}
+    regressions = []
+    for result in current:
+        old = baseline.get(_result_key(result))
+        if old is None or 'seconds' not in old:
+            continue
+        if max(old['seconds'], result['seconds']) >= min_seconds and result['seconds'] > old['seconds'] * (1 + time_threshold):
+            regressions.append((_result_key(result), 'seconds', old['seconds'], result['seconds']))
+        if 'peak_mb' in old and result['peak_mb'] > max(old['peak_mb'] * (1 + memory_threshold), old['peak_mb'] + 1):
+            regressions.append((_result_key(result), 'peak_mb', old['peak_mb'], result['peak_mb']))
+    return regressions
+
+def _print_table(results, columns):
+    print('  '.join('{:>18}'.format(c) for c in columns))
+    for r in results:
+        print('  '.join('{:>18.4g}'.format(r[c]) if isinstance(r[c], float) else '{:>18}'.format(str(r[c])) for c in columns))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark abr_data_format conversion')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    kernels = subparsers.add_parser('kernels', help='Compare scalar conversion kernels')
+    kernels.add_argument('--sizes', nargs='+', type=float, default=[1e6, 1e7, 1e8])
+    kernels.add_argument('--repeat', type=int, default=3)
+    kernels.add_argument('--output', help='Write the results to this JSON file')
+
+    formats = subparsers.add_parser('formats', help='Time the stages of ABRDataFormat for every topology')
+    formats.add_argument('--sizes', nargs='+', type=float, default=[1e4, 1e5, 1e6], help='Numbers of points, up to 1e8')
+    formats.add_argument('--topologies', nargs='+', choices=list(SYNTHETIC_INPUTS), default=None)
+    formats.add_argument('--repeat', type=int, default=3)
+    formats.add_argument('--kernel', default='reference', choices=list(CONVERSION_KERNELS))
+    formats.add_argument('--workers', type=int, default=1)
+    formats.add_argument('--arena', action='store_true')
+    formats.add_argument('--output', help='Write the results to this JSON file')
+    formats.add_argument('--baseline', help='Compare against the results in this JSON file')
+
+    indices = subparsers.add_parser('indices', help='Bytes saved by 16-bit cell indices')
+    indices.add_argument('--sides', nargs='+', type=int, default=[32, 64, 128, 256, 512], help='Grid sizes of the meshes, in points per side')
+    indices.add_argument('--output', help='Write the results to this JSON file')
+
+    compression = subparsers.add_parser('compression', help='Compression ratio and throughput per codec and chunk size')
+    compression.add_argument('--size', type=float, default=1e6, help='Number of points')
+    compression.add_argument('--topologies', nargs='+', choices=list(SYNTHETIC_INPUTS), default=['Triangles', 'Volume'])
+    compression.add_argument('--codecs', nargs='+', default=['zlib:1', 'zlib:6', 'lzma:1'], help='Codecs, as codec or codec:level')
+    compression.add_argument('--chunk-sizes', nargs='+', type=int, default=[1 << 16, 1 << 18, 1 << 20, 1 << 22])
+    compression.add_argument('--workers', nargs='+', type=int, default=[1, 4])
+    compression.add_argument('--repeat', type=int, default=3)
+    compression.add_argument('--output', help='Write the results to this JSON file')
+
+    filters = subparsers.add_parser('filters', help='Compression ratio of exported arrays after each preconditioning filter')
+    filters.add_argument('inputs', nargs='*', help='VTK files to export (default: smooth synthetic data)')
+    filters.add_argument('--side', type=int, default=256, help='Points per side of the synthetic surface')
+    filters.add_argument('--codecs', nargs='+', default=['zlib:1', 'lzma:1'], help='Codecs, as codec or codec:level')
+    filters.add_argument('--repeat', type=int, default=3)
+    filters.add_argument('--output', help='Write the results to this JSON file')
+
+    updates = subparsers.add_parser('updates', help='Bytes and latency of attribute updates against full sends per timestep')
+    updates.add_argument('--sizes', nargs='+', type=float, default=[1e4, 1e5, 1e6], help='Numbers of points')
+    updates.add_argument('--topologies', nargs='+', choices=list(SYNTHETIC_INPUTS), default=['Triangles'])
+    updates.add_argument('--timesteps', type=int, default=10)
+    updates.add_argument('--output', help='Write the results to this JSON file')
+
+    bricks = subparsers.add_parser('bricks', help='Bytes and latency of brick updates of a volume with a moving blob')
+    bricks.add_argument('--sides', nargs='+', type=int, default=[64, 128, 256], help='Points per side of the volume')
+    bricks.add_argument('--brick-sizes', nargs='+', type=int, default=[16, 32, 64])
+    bricks.add_argument('--timesteps', type=int, default=10)
+    bricks.add_argument('--output', help='Write the results to this JSON file')
+
+    latency = subparsers.add_parser('latency', help='Latency of small messages on new and pooled connections')
+    latency.add_argument('--sizes', nargs='+', type=float, default=[1e2, 1e3, 1e4], help='Numbers of points')
+    latency.add_argument('--repeat', type=int, default=200)
+    latency.add_argument('--output', help='Write the results to this JSON file')
+
+    throughput = subparsers.add_parser('throughput', help='Throughput of sending datasets over loopback with each send method')
+    throughput.add_argument('--sizes', nargs='+', type=float, default=[1e5, 1e6, 4e6], help='Numbers of points')
+    throughput.add_argument('--topologies', nargs='+', choices=list(SYNTHETIC_INPUTS), default=['Triangles', 'Volume'])
+    throughput.add_argument('--repeat', type=int, default=3)
+    throughput.add_argument('--output', help='Write the results to this JSON file')
+
+    background = subparsers.add_parser('background', help='Time the pipeline waits while scrubbing, sending in the caller and in the background')
+    background.add_argument('--sizes', nargs='+', type=float, default=[1e4, 1e5, 1e6], help='Numbers of points')
+    background.add_argument('--timesteps', type=int, default=20)
+    background.add_argument('--interval', type=float, default=0.01, help='Seconds between timesteps')
+    background.add_argument('--output', help='Write the results to this JSON file')
+
+    compare = subparsers.add_parser('compare', help='Flag regressions between two results files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    for parser_ in (formats, compare):
+        parser_.add_argument('--time-threshold', type=float, default=0.1, help='Allowed slowdown, as a fraction')
+        parser_.add_argument('--memory-threshold', type=float, default=0.1, help='Allowed peak memory growth, as a fraction')
+        parser_.add_argument('--min-seconds', type=float, default=0.01, help='Ignore times shorter than this')
+
+    args = parser.parse_args(argv)
+    if args.command == 'kernels':
+        results = benchmark_kernels(args.sizes, args.repeat)
+        _print_table(results, ['kernel', 'elements', 'seconds', 'input_gb_per_s', 'speedup_vs_legacy'])
+    elif args.command == 'formats':
+        options = dict(kernel=args.kernel, workers=args.workers, arena=args.arena)
+        results = benchmark_formats(args.sizes, args.topologies, args.repeat, options)
+        _print_table(results, ['topology', 'elements', 'stage', 'seconds', 'payload_mb_per_s', 'peak_mb'])
+    elif args.command == 'indices':
+        results = benchmark_index_bytes(args.sides)
+        _print_table(results, ['mesh', 'elements', 'index_layout', 'index_format', 'payload_bytes', 'index_bytes_saved', 'payload_saved_percent'])
+    elif args.command == 'compression':
+        results = benchmark_compression(args.size, args.topologies, args.codecs, args.chunk_sizes, args.workers, args.repeat)
+        _print_table(results, ['topology', 'codec', 'chunk_size', 'workers', 'ratio', 'compress_mb_per_s', 'decompress_mb_per_s'])
+    elif args.command == 'filters':
+        results = benchmark_filters(args.inputs, args.side, args.codecs, args.repeat)
+        _print_table(results, ['dataset', 'section', 'filters', 'codec', 'ratio', 'filter_mb_per_s', 'compress_mb_per_s', 'unfilter_mb_per_s'])
+    elif args.command == 'updates':
+        results = benchmark_updates(args.sizes, args.topologies, args.timesteps)
+        _print_table(results, ['topology', 'elements', 'message', 'payload_bytes', 'seconds'])
+    elif args.command == 'bricks':
+        results = benchmark_bricks(args.sides, args.brick_sizes, timesteps=args.timesteps)
+        _print_table(results, ['elements', 'brick_size', 'tolerance', 'payload_percent', 'diff_seconds', 'seconds'])
+    elif args.command == 'latency':
+        results = benchmark_latency(args.sizes, args.repeat)
+        _print_table(results, ['message', 'elements', 'payload_bytes', 'connection', 'seconds', 'p99_seconds'])
+    elif args.command == 'throughput':
+        results = benchmark_throughput(args.sizes, args.topologies, args.repeat)
+        _print_table(results, ['topology', 'elements', 'method', 'payload_bytes', 'seconds', 'payload_mb_per_s'])
+    elif args.command == 'background':
+        results = benchmark_background(args.sizes, args.timesteps, args.interval)
+        _print_table(results, ['elements', 'mode', 'payload_bytes', 'blocked_seconds', 'sent', 'dropped', 'last_latency', 'seconds'])
+    else:
+        with open(args.current) as f:
+            results = json.load(f)['results']
+
+    if args.command != 'compare' and args.output:
+        save_results(args.output, results)
+
+    baseline = args.baseline if args.command in ('formats', 'compare') else None
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare_results(json.load(f)['results'], results, args.time_threshold, args.memory_threshold, args.min_seconds)
+        for key, field, old, new in regressions:
+            print('REGRESSION {}: {} {:.4g} -> {:.4g}'.format(', '.join('{}={}'.format(k, v) for k, v in key), field, old, new))
+        print('{} regressions against {}'.format(len(regressions), baseline))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# Bricks.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Splits volumes into cubic bricks and finds the bricks that changed between
+# two versions of a volume, vectorized over a row of bricks at a time. A
+# volume is a (z, y, x) array; bricks are numbered in C order over the
+# (z, y, x) grid of bricks, and those on the far edges are clipped to the
+# volume.
+
+import numpy as np
+
+# Default edge length of a brick, in points (32^3 float32 is 128 KB)
+BRICK_SIZE = 32
+
+def brick_grid(shape, brick_size=BRICK_SIZE):
+    # Number of bricks along each axis
+    return tuple(-(-n // brick_size) for n in shape)
+
+def brick_slices(brick, shape, brick_size=BRICK_SIZE):
+    # Slices of `shape` covered by the brick numbered `brick`
+    corner = np.unravel_index(brick, brick_grid(shape, brick_size))
+    return tuple(slice(c * brick_size, min((c + 1) * brick_size, n)) for c, n in zip(corner, shape))
+
+def _brick_rows(volume, brick_size, dtype):
+    # For each row of bricks along x, (z index, y index, bricks), where
+    # bricks is the row cast to `dtype` and padded with zeros to whole
+    # bricks, shaped (z, y, brick, x). The buffer is reused between rows
+    grid = brick_grid(volume.shape, brick_size)
+    scratch = np.zeros((brick_size, brick_size, grid[2] * brick_size), dtype=dtype)
+    for iz in range(grid[0]):
+        for iy in range(grid[1]):
+            row = volume[iz * brick_size:(iz + 1) * brick_size, iy * brick_size:(iy + 1) * brick_size]
+            if row.shape != scratch.shape:
+                scratch.fill(0)
+            np.copyto(scratch[:row.shape[0], :row.shape[1], :row.shape[2]], row, casting='unsafe')
+            yield iz, iy, scratch.reshape(brick_size, brick_size, grid[2], brick_size)
+
+def _weights(brick_size):
+    # Two fixed sets of pseudo-random odd 64-bit weights, one per brick point
+    rng = np.random.default_rng(brick_size)
+    return rng.integers(0, 1 << 63, size=(2, brick_size, brick_size, brick_size), dtype=np.uint64) * 2 + 1
+
+def brick_signatures(volume, brick_size=BRICK_SIZE):
+    '''
+        A 128-bit signature of each brick of `volume`: two sums, with
+        different pseudo-random weights, of the bits of its values as
+        unsigned integers (mod 2^64). A changed brick keeps its signature
+        only by a chance of about 2^-64 per sum. Returns a uint64 array
+        of shape (bricks along z, y, x, 2).
+    '''
+    volume = np.asarray(volume)
+    bits = volume.view('u{}'.format(volume.dtype.itemsize))
+    weights = _weights(brick_size)
+    signatures = np.empty(brick_grid(volume.shape, brick_size) + (2,), dtype=np.uint64)
+    for iz, iy, bricks in _brick_rows(bits, brick_size, np.uint64):
+        for k in range(2):
+            # Sum over each brick's z, y and x; uint64 arithmetic wraps
+            signatures[iz, iy, :, k] = np.einsum('zybx,zyx->b', bricks, weights[k])
+    return signatures
+
+def brick_max_abs_diff(volume, previous, brick_size=BRICK_SIZE):
+    '''
+        The largest absolute difference between `volume` and `previous`
+        in each brick, as a float64 array of shape (bricks along z, y, x).
+    '''
+    diffs = np.empty(brick_grid(volume.shape, brick_size), dtype=np.float64)
+    rows = zip(_brick_rows(volume, brick_size, np.float64), _brick_rows(previous, brick_size, np.float64))
+    for (iz, iy, bricks), (_, _, previous_bricks) in rows:
+        np.subtract(bricks, previous_bricks, out=bricks)
+        diffs[iz, iy] = np.abs(bricks).max(axis=(0, 1, 3))
+    return diffs
+
+def gather_bricks(volume, bricks, brick_size=BRICK_SIZE):
+    # The values of the numbered bricks of `volume`, one after the other,
+    # each in C order
+    parts = [volume[brick_slices(brick, volume.shape, brick_size)].reshape(-1) for brick in bricks]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=volume.dtype)
+
+def scatter_bricks(volume, bricks, values, brick_size=BRICK_SIZE):
+    # Write values gathered by `gather_bricks` back into `volume`, in place
+    offset = 0
+    for brick in bricks:
+        target = volume[brick_slices(brick, volume.shape, brick_size)]
+        target[...] = values[offset:offset + target.size].reshape(target.shape)
+        offset += target.size
+    return offset
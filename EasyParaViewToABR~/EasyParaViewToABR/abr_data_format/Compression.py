@@ -0,0 +1,104 @@
+# Compression.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Chunked compression of the binary payload, and the reference decoder for
+# it. Each section of the payload is split into chunks of at most
+# `chunk_size` bytes, which are compressed independently (on a thread pool;
+# zlib and lzma release the GIL), so they can be decompressed in parallel
+# too. The compressed payload is framed as (all integers little-endian):
+#
+#   b'ABRC'                        magic
+#   uint32 n                       number of chunks
+#   n x (uint32 raw, uint32 size)  raw and compressed size of each chunk
+#   n compressed chunks, back to back
+
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Default largest number of raw bytes per chunk
+COMPRESSION_CHUNK_SIZE = 1 << 20
+
+MAGIC = b'ABRC'
+
+def _lzma_compress(data, level):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=6 if level is None else level)
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, -1 if level is None else level)
+
+# codec name -> (compress(data, level), decompress(data))
+CODECS = {
+    'zlib': (_zlib_compress, zlib.decompress),
+    'lzma': (_lzma_compress, lzma.decompress),
+}
+
+def _map(func, items, workers):
+    if workers > 1 and len(items) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(func, items))
+    return [func(item) for item in items]
+
+def compress_buffers(buffers, codec='zlib', level=None, chunk_size=COMPRESSION_CHUNK_SIZE, workers=1):
+    '''
+        Compress the payload given as a list of byte buffers (e.g. from
+        `ABRDataFormat.get_buffers()`) with `codec` ('zlib' or 'lzma') at
+        `level` (the codec's default if None). Returns the framed payload
+        as a list of byte buffers: the frame header, then every chunk.
+    '''
+    if codec not in CODECS:
+        raise ValueError('Unsupported compression codec: ' + codec)
+    compress = CODECS[codec][0]
+    chunks = []
+    for buf in buffers:
+        buf = memoryview(buf).cast('B')
+        chunks.extend(buf[start:start + chunk_size] for start in range(0, len(buf), chunk_size))
+
+    compressed = _map(lambda chunk: compress(chunk, level), chunks, workers)
+
+    table = np.empty((len(chunks), 2), dtype='<u4')
+    table[:, 0] = [len(chunk) for chunk in chunks]
+    table[:, 1] = [len(chunk) for chunk in compressed]
+    header = MAGIC + np.array([len(chunks)], dtype='<u4').tobytes() + table.tobytes()
+    return [header] + compressed
+
+def read_chunk_table(data):
+    '''
+        Parse the frame header at the start of `data`. Returns (raw sizes,
+        compressed sizes, offset of the first chunk).
+    '''
+    data = memoryview(data).cast('B')
+    if bytes(data[:4]) != MAGIC:
+        raise ValueError('Not a compressed ABR payload')
+    num_chunks = int(np.frombuffer(data[4:8], dtype='<u4')[0])
+    table = np.frombuffer(data[8:8 + 8 * num_chunks], dtype='<u4').reshape(num_chunks, 2)
+    return table[:, 0].astype(np.int64), table[:, 1].astype(np.int64), 8 + 8 * num_chunks
+
+def decompress_payload(data, codec='zlib', workers=1, out=None):
+    '''
+        Reference decoder: decompress a payload framed by
+        `compress_buffers`, with its chunks decompressed on `workers`
+        threads, into `out` (a new uint8 array if None). Returns `out`.
+    '''
+    if codec not in CODECS:
+        raise ValueError('Unsupported compression codec: ' + codec)
+    decompress = CODECS[codec][1]
+    data = memoryview(data).cast('B')
+    raw_sizes, sizes, first = read_chunk_table(data)
+    raw_offsets = np.concatenate([[0], np.cumsum(raw_sizes)])
+    offsets = np.concatenate([[0], np.cumsum(sizes)]) + first
+    if out is None:
+        out = np.empty(int(raw_offsets[-1]), dtype=np.uint8)
+
+    def decompress_chunk(i):
+        raw = decompress(data[offsets[i]:offsets[i + 1]])
+        if len(raw) != raw_sizes[i]:
+            raise ValueError('Chunk {} decompressed to {} bytes, expected {}'.format(i, len(raw), raw_sizes[i]))
+        out[raw_offsets[i]:raw_offsets[i + 1]] = np.frombuffer(raw, dtype=np.uint8)
+
+    _map(decompress_chunk, list(range(len(raw_sizes))), workers)
+    return out
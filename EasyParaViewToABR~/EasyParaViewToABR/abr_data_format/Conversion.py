@@ -0,0 +1,223 @@
+# Conversion.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Kernels that convert point data arrays into the float32 arrays ABR expects:
+# NaNs become 0, values are cast to float32, and the min/max of the result
+# is reported for the JSON header.
+
+import numpy as np
+
+# Elements converted per block by the fused kernel. A block of float64 input
+# and float32 output (768 KB) stays in cache while it is scrubbed and scanned.
+FUSED_BLOCK_SIZE = 1 << 16
+
+def scrub_into(src, out):
+    '''
+        Same result as `out[...] = np.nan_to_num(src).astype(out.dtype)`, but
+        casts straight into `out` and scrubs in place, with no temporaries.
+        Infinities become the largest value of the *source* type, as
+        nan_to_num would have done before the cast.
+    '''
+    np.copyto(out, src, casting='unsafe')
+    if src.dtype.kind == 'f':
+        with np.errstate(over='ignore'):
+            big = out.dtype.type(np.finfo(src.dtype).max)
+        np.nan_to_num(out, copy=False, posinf=big, neginf=-big)
+
+def convert_scalars(src, out, clamp=False):
+    '''
+        Reference kernel: scrub and cast `src` into `out` with whole-array
+        NumPy operations, then scan for the range. With `clamp`, infinities
+        are replaced by the float32 limits after the range is taken (as the
+        volume path has always done). Returns (min, max).
+    '''
+    scrub_into(src, out)
+    value_range = (float(np.amin(out)), float(np.max(out)))
+    if clamp:
+        np.nan_to_num(out, copy=False)
+    return value_range
+
+def convert_scalars_fused(src, out, clamp=False, block_size=FUSED_BLOCK_SIZE):
+    '''
+        Fused kernel: same output as `convert_scalars`, but NaN scrubbing,
+        casting and the min/max scan happen block by block, so each element
+        is read from memory once. Returns (min, max).
+    '''
+    src = np.asarray(src)
+    if src.ndim > 1 and not src.flags.c_contiguous:
+        # e.g. a flipped volume; each slab along the first axis is contiguous
+        ranges = [convert_scalars_fused(s, o, clamp, block_size) for s, o in zip(src, out)]
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    src = src.reshape(-1)
+    out = out.reshape(-1)
+    is_float = src.dtype.kind == 'f'
+    if is_float:
+        with np.errstate(over='ignore'):
+            big = out.dtype.type(np.finfo(src.dtype).max)
+    nan_mask = np.empty(min(block_size, src.size), dtype=bool)
+
+    low = np.inf
+    high = -np.inf
+    for start in range(0, src.size, block_size):
+        block = out[start:start + block_size]
+        np.copyto(block, src[start:start + block_size], casting='unsafe')
+        if is_float:
+            mask = nan_mask[:block.size]
+            np.isnan(block, out=mask)
+            if mask.any():
+                block[mask] = 0
+        block_low = block.min()
+        block_high = block.max()
+        if is_float and not (np.isfinite(block_low) and np.isfinite(block_high)):
+            # Rare: infinities need the same treatment as nan_to_num gives them
+            np.nan_to_num(block, copy=False, posinf=big, neginf=-big)
+            block_low = block.min()
+            block_high = block.max()
+            if clamp:
+                np.nan_to_num(block, copy=False)
+        low = min(low, block_low)
+        high = max(high, block_high)
+    return float(low), float(high)
+
+CONVERSION_KERNELS = {
+    'reference': convert_scalars,
+    'fused': convert_scalars_fused,
+}
+
+# Scalar encodings: name in the header -> stored dtype. The 'norm' encodings
+# map each array's [scalarMin, scalarMax] onto [0, 2^bits - 1]
+SCALAR_ENCODINGS = {
+    'f32': np.dtype('f4'),
+    'f16': np.dtype('f2'),
+    'u16norm': np.dtype('u2'),
+    'u8norm': np.dtype('u1'),
+}
+
+def _blocks(src, out, block_size):
+    # Matching 1-D blocks of src and out (or None); arrays that are not
+    # contiguous (e.g. a flipped volume) are walked slab by slab along the
+    # first axis
+    if src.ndim > 1 and not src.flags.c_contiguous:
+        for i in range(len(src)):
+            yield from _blocks(src[i], None if out is None else out[i], block_size)
+        return
+    src = src.reshape(-1)
+    out = None if out is None else out.reshape(-1)
+    for start in range(0, src.size, block_size):
+        yield src[start:start + block_size], None if out is None else out[start:start + block_size]
+
+def scalar_range(src, kernel=convert_scalars_fused, clamp=False, block_size=FUSED_BLOCK_SIZE):
+    '''
+        (min, max) of `src` as `kernel` would convert it, computed a block
+        at a time into a scratch block rather than a full output.
+    '''
+    src = np.asarray(src)
+    scratch = np.empty(min(block_size, src.size), dtype='f4')
+    low, high = np.inf, -np.inf
+    for src_block, _ in _blocks(src, None, block_size):
+        block_low, block_high = kernel(src_block, scratch[:src_block.size], clamp)
+        low, high = min(low, block_low), max(high, block_high)
+    return float(low), float(high)
+
+def convert_scalars_encoded(src, out, encoding, kernel=convert_scalars_fused, clamp=False, value_range=None, block_size=FUSED_BLOCK_SIZE):
+    '''
+        Convert `src` with `kernel` (as into float32) and store it in `out`
+        with the given encoding, one block at a time through a float32
+        scratch block. 'f16' is cast, clipped to the float16 range. The
+        'norm' encodings need the `value_range` of the whole array (see
+        `scalar_range`) and store `round((v - min) / (max - min) *
+        (2^bits - 1))`; a constant or unbounded array is all zeros.
+        Returns (min, max) of the float32 values of this part.
+    '''
+    src = np.asarray(src)
+    scratch = np.empty(min(block_size, src.size), dtype='f4')
+    quantize = encoding not in ('f32', 'f16')
+    if quantize:
+        low, high = value_range
+        levels = np.iinfo(SCALAR_ENCODINGS[encoding]).max
+        span = high - low
+        scale = np.float32(levels / span) if np.isfinite(span) and span > 0 else None
+
+    part_low, part_high = np.inf, -np.inf
+    for src_block, out_block in _blocks(src, out, block_size):
+        tmp = scratch[:src_block.size]
+        block_low, block_high = kernel(src_block, tmp, clamp)
+        part_low, part_high = min(part_low, block_low), max(part_high, block_high)
+        if not quantize:
+            if encoding == 'f16':
+                np.clip(tmp, -np.finfo('f2').max, np.finfo('f2').max, out=tmp)
+        elif scale is None:
+            tmp.fill(0)
+        else:
+            np.subtract(tmp, low, out=tmp)
+            np.multiply(tmp, scale, out=tmp)
+            np.rint(tmp, out=tmp)
+            np.clip(tmp, 0, levels, out=tmp)
+        np.copyto(out_block, tmp, casting='unsafe')
+    return float(part_low), float(part_high)
+
+def dequantize(values, encoding, value_min, value_max):
+    '''
+        Float32 values of an array stored by `convert_scalars_encoded`,
+        given the range stored for it in the header (as `scalarMins` and
+        `scalarMaxes`). The 'norm' encodings are exact to within half a
+        step, (max - min) / (2^bits - 1) / 2.
+    '''
+    if encoding in ('f32', 'f16'):
+        return values.astype('f4')
+    levels = np.iinfo(SCALAR_ENCODINGS[encoding]).max
+    # In float64, so ranges near the float32 limits do not overflow
+    return (value_min + values * ((value_max - value_min) / levels)).astype('f4')
+
+def legacy_cells_size(offsets, connectivity):
+    # One count per cell, followed by that cell's point indices
+    return offsets.size - 1 + connectivity.size
+
+def write_legacy_cells(offsets, connectivity, out, first=0, last=None):
+    '''
+        Write cells `first` to `last` (exclusive) in the legacy VTK layout
+        `[n0, i0, i1, ..., n1, j0, j1, ...]` into their place in `out`, which
+        holds the layout for all cells, using VTK 9 style `offsets` and
+        `connectivity` arrays. Indices are cast as they are written.
+    '''
+    if last is None:
+        last = offsets.size - 1
+    counts = np.diff(offsets[first:last + 1])
+    dest = out[offsets[first] + first:offsets[last] + last]
+    connectivity = connectivity[offsets[first]:offsets[last]]
+    if counts.size == 0:
+        return
+
+    if counts.min() == counts.max():
+        # All cells the same size (e.g. all triangles): fill rows directly
+        rows = dest.reshape(counts.size, counts[0] + 1)
+        rows[:, 0] = counts[0]
+        np.copyto(rows[:, 1:], connectivity.reshape(counts.size, counts[0]), casting='unsafe')
+    else:
+        count_positions = offsets[first:last] - offsets[first] + np.arange(counts.size)
+        is_index = np.ones(dest.size, dtype=bool)
+        is_index[count_positions] = False
+        dest[count_positions] = counts
+        dest[is_index] = connectivity
+
+def fill_arange(out, start=0):
+    '''
+        Write `start, start + 1, ...` into `out` in place, which may be a
+        strided view. Unlike np.arange, no temporary array is built.
+    '''
+    if out.size == 0:
+        return
+    out.fill(1)
+    out[0] = start
+    np.cumsum(out, out=out, dtype=out.dtype)
+
+def write_point_cells(rows, start=0):
+    '''
+        Write legacy cells for points `start, start + 1, ...`, where every
+        point is a cell of its own, into `rows` of shape (n, 2): `[1, i]`.
+    '''
+    rows[:, 0] = 1
+    fill_arange(rows[:, 1], start)
@@ -0,0 +1,72 @@
+# Filters.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Reversible filters that precondition a section of the payload before it is
+# compressed. Generic compressors find little to repeat in raw float32
+# fields, but smooth fields change slowly from one point to the next, so:
+#
+#   'delta'    replaces each value with its difference from the previous
+#              point's (along x, the fastest axis, for volumes)
+#   'xor'      replaces each value with its XOR with the previous point's,
+#              which zeroes the sign, exponent and high mantissa bits that
+#              smooth vertex coordinates share
+#   'shuffle'  transposes the bytes of the values into planes (all first
+#              bytes, then all second bytes, ...), so the slowly changing
+#              high bytes sit together
+#
+# 'delta' and 'xor' work on the bits of the values as unsigned integers, so
+# they are exactly reversible for floats too. A point's values are compared
+# with the same component of the previous point (e.g. x with x).
+
+import numpy as np
+
+FILTERS = ('delta', 'xor', 'shuffle')
+
+def _as_unsigned(array, components):
+    # The values as unsigned integers of the same size, one row per point
+    return array.view('u{}'.format(array.dtype.itemsize)).reshape(-1, components)
+
+def apply_filters(array, filters, components=1):
+    '''
+        Apply `filters` (names from FILTERS, in order) to a copy of the
+        section `array`, with `components` values per point. Returns the
+        filtered bytes as a uint8 array.
+    '''
+    for name in filters:
+        if name not in FILTERS:
+            raise ValueError('Unsupported filter: ' + name)
+    array = np.ascontiguousarray(array)
+    dtype = array.dtype
+    out = np.array(array.reshape(-1))
+    for name in filters:
+        if name == 'shuffle':
+            out = np.ascontiguousarray(out.view(np.uint8).reshape(-1, dtype.itemsize).T).reshape(-1).view(dtype)
+            continue
+        values = _as_unsigned(out, components)
+        if name == 'delta':
+            np.subtract(values[1:], values[:-1], out=values[1:])
+        else:
+            np.bitwise_xor(values[1:], values[:-1], out=values[1:])
+    return out.view(np.uint8)
+
+def reverse_filters(data, dtype, filters, components=1):
+    '''
+        Undo `apply_filters(array, filters, components)` in place, given the
+        filtered bytes `data` (a writable uint8 array) and the section's
+        `dtype`. Returns `data` viewed as `dtype`.
+    '''
+    dtype = np.dtype(dtype)
+    out = data.view(dtype)
+    for name in reversed(filters):
+        if name == 'shuffle':
+            out[...] = np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T).reshape(-1).view(dtype)
+        elif name in ('delta', 'xor'):
+            values = _as_unsigned(out, components)
+            # Accumulate in the values' own type, so deltas wrap around
+            accumulate = np.add.accumulate if name == 'delta' else np.bitwise_xor.accumulate
+            accumulate(values, axis=0, dtype=values.dtype, out=values)
+        else:
+            raise ValueError('Unsupported filter: ' + name)
+    return out
@@ -0,0 +1,76 @@
+# Profile.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Records how long each stage of an ABRDataFormat conversion took, how many
+# bytes of payload it produced and, optionally, how much memory it allocated
+
+import json
+import time
+import tracemalloc
+
+class Profile:
+    '''
+        A list of stage records (`stages`), one dict per stage:
+        `{'label', 'stage', 'seconds', 'bytes'}`, plus `peak_bytes` (the
+        most memory traced by tracemalloc during the stage, above what was
+        allocated before it) when `memory` is True.
+
+        If `log` is given, it is called with each record as a line of JSON
+        as soon as the stage ends.
+    '''
+    def __init__(self, label, memory=False, log=None):
+        self.label = label
+        self.memory = memory
+        self.log = log
+        self.stages = []
+
+    def stage(self, name, nbytes=0):
+        '''
+            Context manager that records the stage `name`, which produces
+            `nbytes` bytes of payload. Stages should not be nested.
+        '''
+        return _Stage(self, name, nbytes)
+
+    def add(self, name, seconds, nbytes=0, **fields):
+        record = {'label': self.label, 'stage': name, 'seconds': seconds, 'bytes': int(nbytes)}
+        record.update(fields)
+        self.stages.append(record)
+        if self.log is not None:
+            self.log(json.dumps(record))
+        return record
+
+    def total_seconds(self):
+        return sum(record['seconds'] for record in self.stages)
+
+    def to_json_lines(self):
+        return '\n'.join(json.dumps(record) for record in self.stages)
+
+class _Stage:
+    def __init__(self, profile, name, nbytes):
+        self.profile = profile
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        if self.profile.memory:
+            # Trace just this stage, unless something else already is
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        fields = {}
+        if self.profile.memory:
+            fields['peak_bytes'] = max(0, tracemalloc.get_traced_memory()[1] - self.base)
+            if self.started_tracing:
+                tracemalloc.stop()
+        self.profile.add(self.name, seconds, self.nbytes, **fields)
+        return False
@@ -0,0 +1,276 @@
+# Receiver.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# A stand-in for Unity's SocketDataListener, to test senders without Unity.
+# It speaks the same socket protocol (all lengths are big-endian uint32):
+#
+#   label length, label       'update' asks for a re-render; no more follows
+#   JSON length, JSON header
+#   payload length, payload
+#
+# and replies with a length-prefixed ack string. Unlike Unity, it also reads
+# the update messages of Updates.py (resends, attribute and brick updates),
+# and it acks only once it has applied a message: 'ok', 'missing' if the
+# message needs a previous version it lacks, or 'error: <reason>' if it
+# cannot be applied. A connection that starts with the
+# keep-alive handshake of Sender.py (acked 'keep-alive') then carries any
+# number of messages, until the sender closes it.
+
+import copy
+import json
+import socket
+import struct
+import threading
+
+import numpy as np
+
+from .ABRDataReader import ABRDataReader, get_sections, get_section_names
+from .Bricks import brick_slices, scatter_bricks
+from .Conversion import SCALAR_ENCODINGS
+from .Sender import recv_exactly, read_string, write_string
+
+def split_payload(json_header, payload):
+    # Memoryviews of each section of a raw payload, by section name
+    payload = memoryview(payload).cast('B')
+    sections = {}
+    offset = 0
+    for name, (_, dtype, shape) in zip(get_section_names(json_header), get_sections(json_header)):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        sections[name] = payload[offset:offset + nbytes]
+        offset += nbytes
+    return sections
+
+class Receiver:
+    '''
+        Listens on (`host`, `port`) (port 0 picks a free port; see
+        `address`) and handles each connection on a thread of its own once
+        started. The last version of each label is kept in `datasets`, as
+        an ABRDataReader; `messages` lists the (label, payload bytes) of
+        each message received, `updates` counts re-render requests, and
+        `connections` counts the connections accepted. With `keep_alive`
+        False, it declines the keep-alive handshake, as Unity does.
+
+        Use as a context manager, or call `start()` and `stop()`.
+    '''
+    def __init__(self, host='localhost', port=0, workers=1, keep_alive=True):
+        self.workers = workers
+        self.keep_alive = keep_alive
+        self.datasets = {}
+        self.messages = []
+        self.updates = 0
+        self.connections = 0
+        self._open = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._listener = socket.create_server((host, port))
+        self._listener.settimeout(0.1)
+        self.address = self._listener.getsockname()[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._listener.close()
+        # Wake the threads waiting on kept-alive connections
+        with self._lock:
+            for conn in self._open:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _serve(self):
+        while not self._stopping.is_set():
+            try:
+                conn, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        with self._lock:
+            self.connections += 1
+            self._open.add(conn)
+        with conn:
+            try:
+                if self._handle(conn):
+                    while not self._stopping.is_set():
+                        self._handle(conn)
+            except OSError:
+                # Including the sender closing the connection
+                pass
+            finally:
+                with self._lock:
+                    self._open.discard(conn)
+
+    def _handle(self, conn):
+        # Handle one message; returns whether it asked to keep the
+        # connection open
+        label = read_string(conn)
+        if label == 'update':
+            with self._lock:
+                self.updates += 1
+            write_string(conn, 'ack')
+            write_string(conn, 'ok')
+            return False
+        json_text = read_string(conn)
+        payload = recv_exactly(conn, struct.unpack('>I', recv_exactly(conn, 4))[0])
+        keep_alive = False
+        try:
+            json_header = json.loads(json_text)
+            if label == '':
+                # Unity acks an empty label without reading it
+                keep_alive = self.keep_alive and json_header.get('keepAlive', False)
+                ack = 'keep-alive' if keep_alive else 'ok'
+            else:
+                ack = self.apply(label, json_header, payload)
+        except Exception as e:
+            # The whole message was read, so the connection can go on
+            ack = 'error: {}'.format(e)
+        write_string(conn, ack)
+        return keep_alive
+
+    def apply(self, label, json_header, payload):
+        '''
+            Apply a message for `label` as its receiver would, and return the
+            ack: 'ok', or 'missing' if the message updates a previous version
+            that this receiver does not have (or that does not match). A
+            message that does not match its header raises ValueError, and
+            leaves the previous version as it was.
+        '''
+        json_header = dict(json_header)
+        update = json_header.pop('update', None)
+        reused = json_header.pop('reuseSections', None)
+        with self._lock:
+            self.messages.append((label, len(payload)))
+            previous = self.datasets.get(label)
+            if (update is not None or reused) and previous is None:
+                return 'missing'
+            if update == 'attributes':
+                json_header, payload = self._apply_attributes(previous, json_header, payload)
+            elif update == 'bricks':
+                json_header, payload = self._apply_bricks(previous, json_header, payload)
+            elif update is not None:
+                raise ValueError('Unsupported update: ' + update)
+            elif reused:
+                payload = self._reuse_sections(previous, json_header, payload, reused)
+            if payload is None:
+                return 'missing'
+            if payload is not getattr(previous, 'arena', None):
+                self.datasets[label] = ABRDataReader.from_payload(json_header, payload, label, self.workers)
+        return 'ok'
+
+    def _reuse_sections(self, previous, json_header, payload, reused):
+        old = split_payload(previous.json_header, previous.arena)
+        parts = []
+        offset = 0
+        for name, (_, dtype, shape) in zip(get_section_names(json_header), get_sections(json_header)):
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if name in reused:
+                if name not in old or len(old[name]) != nbytes:
+                    return None
+                parts.append(old[name])
+            else:
+                parts.append(memoryview(payload)[offset:offset + nbytes])
+                offset += nbytes
+        if offset != len(payload):
+            raise ValueError('Payload holds {} bytes, but its header describes {}'.format(len(payload), offset))
+        return bytearray().join(parts)
+
+    def _apply_attributes(self, previous, update, payload):
+        # The header and payload of the previous version with the arrays of
+        # an attribute update replaced (or added)
+        num_points = previous.json_header['num_points']
+        if update['num_points'] != num_points:
+            return None, None
+        json_header = copy.deepcopy(previous.json_header)
+        names = json_header['scalarArrayNames']
+        encodings = json_header.get('scalarEncodings', ['f32'] * len(names))
+        update_encodings = update.get('scalarEncodings', ['f32'] * len(update['scalarArrayNames']))
+        payload = memoryview(payload)
+        arrays = {}
+        # Whether arrays are added or change type, so views of them change
+        new_layout = False
+        offset = 0
+        for name, low, high, encoding in zip(update['scalarArrayNames'], update['scalarMins'], update['scalarMaxes'], update_encodings):
+            nbytes = num_points * SCALAR_ENCODINGS[encoding].itemsize
+            arrays['scalars/' + name] = payload[offset:offset + nbytes]
+            offset += nbytes
+            if name not in names:
+                names.append(name)
+                json_header['scalarMins'].append(low)
+                json_header['scalarMaxes'].append(high)
+                encodings.append(encoding)
+                new_layout = True
+            else:
+                i = names.index(name)
+                json_header['scalarMins'][i] = low
+                json_header['scalarMaxes'][i] = high
+                new_layout = new_layout or encodings[i] != encoding
+                encodings[i] = encoding
+        for name in update['vectorArrayNames']:
+            arrays['vectors/' + name] = payload[offset:offset + num_points * 12]
+            offset += num_points * 12
+            if name not in json_header['vectorArrayNames']:
+                json_header['vectorArrayNames'].append(name)
+                new_layout = True
+        if offset != len(payload):
+            raise ValueError('Payload holds {} bytes, but its header describes {}'.format(len(payload), offset))
+
+        if any(encoding != 'f32' for encoding in encodings):
+            json_header['scalarEncodings'] = encodings
+        else:
+            json_header.pop('scalarEncodings', None)
+        old = split_payload(previous.json_header, previous.arena)
+        if previous.arena.flags.writeable and not new_layout:
+            # Same arrays as before: patch them in place
+            for name, array in arrays.items():
+                old[name][:] = array
+            previous.json_header.update(json_header)
+            return previous.json_header, previous.arena
+        return json_header, bytearray().join(arrays.get(name, old.get(name)) for name in get_section_names(json_header))
+
+    def _apply_bricks(self, previous, update, payload):
+        # Patch the bricks of a brick update into the previous version, in
+        # place (in a copy if it is read-only)
+        json_header = previous.json_header
+        if (update['num_points'] != json_header['num_points'] or list(update['dimensions']) != list(json_header['dimensions'])
+                or update['scalarArrayNames'] != json_header['scalarArrayNames']):
+            return None, None
+        # Check the payload size before patching anything
+        shape = (json_header['dimensions'][2], json_header['dimensions'][1], json_header['dimensions'][0])
+        nbytes = 0
+        for arr, numbers in zip(previous.scalar_arrays, update['bricks']):
+            sizes = [int(np.prod([s.stop - s.start for s in brick_slices(n, shape, update['brickSize'])])) for n in numbers]
+            nbytes += sum(sizes) * arr.dtype.itemsize
+        if nbytes != len(payload):
+            raise ValueError('Payload holds {} bytes, but its bricks take {}'.format(len(payload), nbytes))
+        arena = previous.arena
+        if not arena.flags.writeable:
+            arena = bytearray(arena)
+            previous = ABRDataReader.from_payload(json_header, arena, previous.label)
+        payload = memoryview(payload)
+        offset = 0
+        for arr, numbers in zip(previous.scalar_arrays, update['bricks']):
+            values = np.frombuffer(payload[offset:], dtype=arr.dtype)
+            offset += scatter_bricks(arr.reshape(shape), numbers, values, update['brickSize']) * arr.dtype.itemsize
+        json_header['scalarMins'] = update['scalarMins']
+        json_header['scalarMaxes'] = update['scalarMaxes']
+        return json_header, arena
@@ -0,0 +1,307 @@
+# Sender.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Sends datasets to ABR's SocketDataListener (or to the stand-in in
+# Receiver.py) outside of ParaView, with the same protocol as the
+# EasyParaViewToABR plugin. Anything with `label`, `json_header`, `bufsize`
+# and `write_into` can be sent: an ABRDataFormat, an ABRDataReader, or an
+# update message from Updates.py. A message's framing and payload go out
+# together in scatter-gather sends straight from its arrays.
+#
+# Unity handles one message per connection. A ConnectionPool asks each
+# receiver to keep connections open for more messages, with a handshake that
+# Unity ignores: a message with an empty label, a `{"keepAlive": true}`
+# header and no payload. Unity acks it with 'ok'; a receiver that keeps the
+# connection open for further messages acks it with 'keep-alive'.
+#
+# A SendQueue sends in the background, so that the caller (e.g. ParaView's
+# pipeline) does not wait for the receiver.
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+# Socket send buffer size, so that large payloads are not sent in small
+# pieces
+SEND_BUFFER_SIZE = 1 << 22
+
+KEEP_ALIVE_HEADER = {'keepAlive': True}
+
+# Most buffers gathered into one sendmsg call; sysconf gives -1 where the
+# limit is unknown
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+IOV_MAX = min(IOV_MAX, 1024) if IOV_MAX > 0 else 16
+
+def recv_exactly(sock, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    offset = 0
+    while offset < nbytes:
+        n = sock.recv_into(view[offset:])
+        if n == 0:
+            raise ConnectionError('Connection closed after {} of {} bytes'.format(offset, nbytes))
+        offset += n
+    return buf
+
+def read_string(sock):
+    # A length-prefixed string, without the NULs Unity may pad it with
+    length = struct.unpack('>I', recv_exactly(sock, 4))[0]
+    return recv_exactly(sock, length).decode().replace('\0', '')
+
+def _framed(text):
+    text = text.encode()
+    return struct.pack('>I', len(text)) + text
+
+def write_string(sock, text):
+    sock.sendall(_framed(text))
+
+def send_buffers(sock, buffers):
+    '''
+        Send the bytes-like `buffers` one after the other without copying
+        them: gathered into as few `sendmsg` calls as the kernel allows, or
+        with a `sendall` each where there is no `sendmsg` (Windows).
+    '''
+    buffers = [view for view in (memoryview(buf).cast('B') for buf in buffers) if len(view) > 0]
+    if not hasattr(sock, 'sendmsg'):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i:i + IOV_MAX])
+        # Skip the buffers sent whole, and the part sent of the next one
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if sent > 0:
+            buffers[i] = buffers[i][sent:]
+
+def open_connection(host, port, timeout=None):
+    '''
+        Connect to a receiver, with Nagle's algorithm off (small messages
+        and acks go out at once) and a large send buffer.
+    '''
+    sock = socket.create_connection((host, port), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    return sock
+
+def write_message(sock, message):
+    # A deferred dataset is converted (and compressed) first, which fills in
+    # its header and payload size
+    message.get_buffers()
+    # The label, header and payload length are sent with the payload
+    header = _framed(message.label) + _framed(json.dumps(message.json_header)) + struct.pack('>I', message.bufsize)
+    message.write_into(sock, header)
+
+def request_update(sock):
+    # Ask the receiver to re-render; it replies 'ack', then 'ok' once done
+    write_string(sock, 'update')
+    read_string(sock)
+    return read_string(sock)
+
+def _request_keep_alive(sock):
+    sock.sendall(_framed('') + _framed(json.dumps(KEEP_ALIVE_HEADER)) + struct.pack('>I', 0))
+    return read_string(sock) == 'keep-alive'
+
+def send_message(host, port, message):
+    '''
+        Send one message on a new connection and return the receiver's ack.
+    '''
+    with open_connection(host, port) as sock:
+        write_message(sock, message)
+        return read_string(sock)
+
+class ConnectionPool:
+    '''
+        Open connections to receivers, by (host, port), reused for one
+        message after another. Whether a receiver keeps connections open is
+        asked on the first connection to it; for those that do not (Unity),
+        each message gets a new connection, as with `send_message()`.
+
+        If an idle connection turns out to be closed (e.g. the receiver
+        restarted), the message is sent again on a new one. Safe to use from
+        several threads: each connection carries one message at a time.
+    '''
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._idle = {}
+        self._keep_alive = {}
+        self._lock = threading.Lock()
+
+    def send(self, host, port, message):
+        '''
+            Send `message` and return the receiver's ack.
+        '''
+        def send(sock):
+            write_message(sock, message)
+            return read_string(sock)
+        return self._call((host, port), send)
+
+    def send_update(self, host, port):
+        '''
+            Ask the receiver to re-render, and return its 'ok'.
+        '''
+        return self._call((host, port), request_update)
+
+    def close(self, host=None, port=None):
+        # Close the idle connections to one receiver, or to all of them, and
+        # ask again whether it keeps connections open
+        with self._lock:
+            keys = [key for key in self._idle if host is None or key == (host, port)]
+            idle = [sock for key in keys for sock in self._idle.pop(key)]
+            for key in list(self._keep_alive):
+                if host is None or key == (host, port):
+                    del self._keep_alive[key]
+        for sock in idle:
+            sock.close()
+
+    def _call(self, key, func):
+        sock, reused = self._acquire(key)
+        try:
+            result = func(sock)
+        except OSError as e:
+            sock.close()
+            # A timeout is a slow receiver, not a closed connection
+            if not reused or isinstance(e, socket.timeout):
+                raise
+            sock = self._connect(key)
+            try:
+                result = func(sock)
+            except BaseException:
+                sock.close()
+                raise
+        except BaseException:
+            # Anything else leaves the connection in an unknown state
+            sock.close()
+            raise
+        self._release(key, sock)
+        return result
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _connect(self, key):
+        sock = open_connection(*key, timeout=self.timeout)
+        if self._keep_alive.get(key) is False:
+            return sock
+        try:
+            keep_alive = _request_keep_alive(sock)
+        except OSError:
+            sock.close()
+            raise
+        self._keep_alive[key] = keep_alive
+        if not keep_alive:
+            # The receiver is done with this connection
+            sock.close()
+            sock = open_connection(*key, timeout=self.timeout)
+        return sock
+
+    def _release(self, key, sock):
+        if not self._keep_alive.get(key):
+            sock.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(sock)
+
+class SendQueue:
+    '''
+        Runs sends on a thread of its own, one at a time, in the order they
+        were submitted. A send is submitted as a function under a key (e.g.
+        the label it sends); if a send under the same key is still queued,
+        the new one replaces it (latest wins) and goes to the back of the
+        queue, so a receiver that falls behind gets only the latest version
+        of each dataset.
+
+        Counters: `depth` (sends queued), `sent`, `dropped` (replaced while
+        queued), `failed` (raised an exception, which is printed, or
+        returned False, e.g. after logging why), and the latency from
+        submit until the send returned: `last_latency`, `max_latency` and
+        `total_latency`, in seconds. `stats()` gives them all as a dict.
+    '''
+    def __init__(self):
+        self._queue = OrderedDict()
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def submit(self, key, func):
+        with self._condition:
+            if self._queue.pop(key, None) is not None:
+                self.dropped += 1
+            self._queue[key] = (func, time.perf_counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        '''
+            Wait until every queued send is done; returns False on timeout.
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def stats(self):
+        with self._condition:
+            done = self.sent + self.failed
+            return {
+                'depth': self.depth,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'last_latency': self.last_latency,
+                'mean_latency': self.total_latency / done if done else None,
+                'max_latency': self.max_latency,
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: self._queue)
+                _, (func, submitted) = self._queue.popitem(last=False)
+                self._busy = True
+            try:
+                failed = func() is False
+            except Exception:
+                traceback.print_exc()
+                failed = True
+            latency = time.perf_counter() - submitted
+            with self._condition:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.sent += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+
+# Shared by all senders in the process
+POOL = ConnectionPool()
+QUEUE = SendQueue()
@@ -0,0 +1,262 @@
+# Updates.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Messages that update a dataset the receiver already has, instead of sending
+# all of it again. These extend the socket protocol, and Unity does not read
+# them yet; `Receiver.py` is a stand-in receiver that does.
+#
+# There are three kinds of update:
+#
+# - A resend lists the sections that did not change since the last send of
+#   its label as `reuseSections` in the header, and leaves them out of the
+#   payload: the receiver takes them from its copy of the previous version.
+# - An attribute update (`"update": "attributes"` in the header) carries only
+#   some scalar and vector arrays of a label, with their new ranges, for
+#   time series whose mesh does not change. The header lists the arrays as
+#   in a full header (scalarArrayNames, scalarMins, scalarMaxes,
+#   scalarEncodings if not all f32, and vectorArrayNames), along with
+#   num_points; the payload holds the scalar arrays, then the vector arrays.
+# - A brick update (`"update": "bricks"`) carries only the bricks (see
+#   Bricks.py) of a volume's scalar arrays that changed. The header has the
+#   volume's num_points, dimensions, brickSize, and the names and new ranges
+#   of all of its scalar arrays (scalarArrayNames, scalarMins, scalarMaxes),
+#   plus `bricks`, the numbers of the changed bricks of each array, in the
+#   stored (z, y, x) layout, which is flipped along z. The payload holds
+#   the values of those bricks, array by array and brick by brick.
+
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .ABRDataFormat import PayloadWriter
+from .Bricks import BRICK_SIZE, brick_signatures, brick_max_abs_diff, gather_bricks, scatter_bricks
+
+# Sections are hashed in blocks of this many bytes, so that a large section
+# can be hashed on several threads
+HASH_BLOCK_SIZE = 1 << 24
+
+def hash_sections(sections, workers=1):
+    '''
+        Content hash of each of the named `sections` ((name, array) pairs,
+        e.g. from `ABRDataFormat.get_named_sections()`), as a dict of name
+        -> hex digest: the SHA-256 of the SHA-256 digests of the section's
+        blocks. The blocks are hashed in place, on `workers` threads
+        (hashlib releases the GIL).
+    '''
+    blocks = []
+    for i, (_, arr) in enumerate(sections):
+        buf = memoryview(np.ascontiguousarray(arr)).cast('B')
+        blocks.extend((i, buf[start:start + HASH_BLOCK_SIZE]) for start in range(0, max(len(buf), 1), HASH_BLOCK_SIZE))
+
+    def digest(block):
+        return hashlib.sha256(block[1]).digest()
+
+    if workers > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            digests = list(pool.map(digest, blocks))
+    else:
+        digests = [digest(block) for block in blocks]
+
+    combined = [hashlib.sha256() for _ in sections]
+    for (i, _), block_digest in zip(blocks, digests):
+        combined[i].update(block_digest)
+    return {name: h.hexdigest() for (name, _), h in zip(sections, combined)}
+
+class Message(PayloadWriter):
+    '''
+        A message to send in place of a dataset: a label, a JSON header and
+        a payload given as a list of byte buffers. It is sent just like an
+        ABRDataFormat.
+    '''
+    def __init__(self, label, json_header, buffers):
+        self.label = label
+        self.json_header = json_header
+        self.buffers = buffers
+        self.bufsize = sum(len(buf) for buf in buffers)
+
+    def get_buffers(self):
+        return self.buffers
+
+class SectionHashes:
+    '''
+        For each label, the content hashes of the sections last sent to (and
+        acknowledged by) a receiver. `make_update()` builds the message for
+        a new version of a dataset, leaving out the sections whose hashes
+        did not change; once the receiver acknowledges it, `update()` the
+        table with the hashes it returned. If the receiver has lost its copy
+        (e.g. it restarted), `forget()` the label and send it whole. Safe to
+        use from several threads, e.g. forgotten on one while another sends.
+    '''
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def make_update(self, formatted):
+        '''
+            Returns (message, hashes) for the ABRDataFormat `formatted`,
+            which must not be compressed.
+        '''
+        if 'compression' in formatted.json_header:
+            raise ValueError('Compressed datasets are sent whole')
+        sections = formatted.get_named_sections()
+        hashes = hash_sections(sections, self.workers)
+        with self._lock:
+            previous = self.tables.get(formatted.label, {})
+        reused = [name for name, _ in sections if previous.get(name) == hashes[name]]
+
+        json_header = formatted.json_header
+        if reused:
+            json_header = dict(json_header, reuseSections=reused)
+        buffers = [memoryview(np.ascontiguousarray(arr)).cast('B') for name, arr in sections if name not in reused]
+        return Message(formatted.label, json_header, buffers), hashes
+
+    def update(self, label, hashes):
+        with self._lock:
+            self.tables[label] = hashes
+
+    def forget(self, label=None):
+        # One label, or all of them
+        with self._lock:
+            if label is None:
+                self.tables.clear()
+            else:
+                self.tables.pop(label, None)
+
+def make_attribute_update(formatted, scalars=None, vectors=None):
+    '''
+        An attribute update message carrying the scalar and vector arrays of
+        `formatted` (an ABRDataFormat) named in `scalars` and `vectors`
+        (default: all of them), to send for a label whose mesh the receiver
+        already has.
+    '''
+    json_header = formatted.json_header
+    if 'compression' in json_header:
+        raise ValueError('Compressed datasets are sent whole')
+    sections = dict(formatted.get_named_sections())
+    all_scalars = json_header['scalarArrayNames']
+    scalars = all_scalars if scalars is None else list(scalars)
+    vectors = json_header['vectorArrayNames'] if vectors is None else list(vectors)
+    for kind, names in (('scalars', scalars), ('vectors', vectors)):
+        for name in names:
+            if kind + '/' + name not in sections:
+                raise ValueError('{} has no {} array named {}'.format(formatted.label, kind[:-1], name))
+
+    indices = [all_scalars.index(name) for name in scalars]
+    update = {
+        'update': 'attributes',
+        'num_points': json_header['num_points'],
+        'scalarArrayNames': scalars,
+        'scalarMins': [json_header['scalarMins'][i] for i in indices],
+        'scalarMaxes': [json_header['scalarMaxes'][i] for i in indices],
+        'vectorArrayNames': vectors,
+    }
+    if 'scalarEncodings' in json_header:
+        update['scalarEncodings'] = [json_header['scalarEncodings'][i] for i in indices]
+    buffers = [memoryview(np.ascontiguousarray(sections['scalars/' + name])).cast('B') for name in scalars]
+    buffers.extend(memoryview(np.ascontiguousarray(sections['vectors/' + name])).cast('B') for name in vectors)
+    return Message(formatted.label, update, buffers)
+
+class BrickDiff:
+    '''
+        For each label of a volume, what was last sent (and acknowledged) of
+        each scalar array, brick by brick, to find the bricks that changed
+        since. `make_update()` builds the message for a new version;
+        once the receiver acknowledges it, `update()` the table with the
+        state it returned. If the receiver has lost its copy, `forget()`
+        the label and make the update again. Safe to use from several
+        threads, like SectionHashes, with one send of a label at a time.
+
+        With `tolerance` None, bricks are compared by their signatures
+        (`Bricks.brick_signatures`), which only take 16 bytes per brick;
+        any change to a brick is sent. Otherwise a copy of what was sent is
+        kept, and a brick is sent once any of its values is off by more
+        than `tolerance` from the receiver's copy.
+    '''
+    def __init__(self, brick_size=BRICK_SIZE, tolerance=None):
+        self.brick_size = brick_size
+        self.tolerance = tolerance
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def make_update(self, formatted):
+        '''
+            Returns (message, state) for the volume `formatted` (an
+            ABRDataFormat, not compressed). The message is a brick update,
+            or `formatted` itself if it has to be sent whole: on its first
+            send, or if its dimensions, arrays, encodings or vector arrays
+            changed (with a `tolerance`, also if the range of an array with
+            a 'norm' encoding changed). Raises ValueError if `formatted` is
+            not image data.
+        '''
+        json_header = formatted.json_header
+        if 'compression' in json_header:
+            raise ValueError('Compressed datasets are sent whole')
+        # Unstructured volumes (tetrahedra, hexahedra) have no grid of bricks
+        if json_header.get('dimensions') is None:
+            raise ValueError('Brick updates are only for image data')
+        dims = json_header['dimensions']
+        shape = (dims[2], dims[1], dims[0])
+        names = json_header['scalarArrayNames']
+        encodings = json_header.get('scalarEncodings')
+        sections = formatted.get_named_sections()
+        volumes = [arr.reshape(shape) for name, arr in sections if name.startswith('scalars/')]
+        ranges = None
+        if self.tolerance is not None and any(encoding.endswith('norm') for encoding in encodings or []):
+            # Bricks that are not sent keep values quantized to the old
+            # range, so a new range means a whole send
+            ranges = [json_header['scalarMins'], json_header['scalarMaxes']]
+        layout = json.dumps([list(dims), names, encodings, self.brick_size, ranges])
+        vectors = hash_sections([(name, arr) for name, arr in sections if name.startswith('vectors/')])
+
+        if self.tolerance is None:
+            bricks = [brick_signatures(volume, self.brick_size) for volume in volumes]
+        with self._lock:
+            previous = self.tables.get(formatted.label)
+        if previous is None or previous['layout'] != layout or previous['vectors'] != vectors:
+            if self.tolerance is not None:
+                bricks = [np.array(volume) for volume in volumes]
+            return formatted, {'layout': layout, 'vectors': vectors, 'bricks': bricks}
+
+        if self.tolerance is None:
+            changed = [np.flatnonzero((new != old).any(axis=-1)) for new, old in zip(bricks, previous['bricks'])]
+            state = {'layout': layout, 'vectors': vectors, 'bricks': bricks}
+        else:
+            changed = [np.flatnonzero(brick_max_abs_diff(volume, old, self.brick_size) > self.tolerance)
+                for volume, old in zip(volumes, previous['bricks'])]
+            # The receiver's copy changes only where bricks are sent
+            state = {'layout': layout, 'vectors': vectors, 'patch': (changed, volumes)}
+
+        update = {
+            'update': 'bricks',
+            'num_points': json_header['num_points'],
+            'dimensions': list(dims),
+            'brickSize': self.brick_size,
+            'scalarArrayNames': names,
+            'scalarMins': json_header['scalarMins'],
+            'scalarMaxes': json_header['scalarMaxes'],
+            'bricks': [numbers.tolist() for numbers in changed],
+        }
+        buffers = [memoryview(gather_bricks(volume, numbers, self.brick_size)).cast('B') for volume, numbers in zip(volumes, changed)]
+        return Message(formatted.label, update, buffers), state
+
+    def update(self, label, state):
+        with self._lock:
+            if 'patch' not in state:
+                self.tables[label] = state
+            elif label in self.tables:
+                for copy, numbers, volume in zip(self.tables[label]['bricks'], *state['patch']):
+                    scatter_bricks(copy, numbers, gather_bricks(volume, numbers, self.brick_size), self.brick_size)
+
+    def forget(self, label=None):
+        # One label, or all of them
+        with self._lock:
+            if label is None:
+                self.tables.clear()
+            else:
+                self.tables.pop(label, None)
@@ -1,4 +1,7 @@
 from .ABRDataFormat import ABRDataFormat
 from .ABRDataFormat import UnityMeshTopology
 from .ABRDataFormat import get_unity_topology
-from .DataPath import DataPath
\ No newline at end of file
+from .ABRDataFormat import cell_type_histogram
+from .ABRDataFormat import split_by_topology
+from .DataPath import DataPath
+from .ABRDataReader import ABRDataReader
\ No newline at end of file
@@ -0,0 +1,135 @@
+# conftest.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Small VTK datasets of each kind ABRDataFormat converts, shared by the
+# tests. Run the tests from the EasyParaViewToABR folder:
+#
+#   python -m pytest -q tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import vtk
+from vtk.util import numpy_support
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _add_array(vtk_data, name, values):
+    arr = numpy_support.numpy_to_vtk(values, deep=1)
+    arr.SetName(name)
+    vtk_data.GetPointData().AddArray(arr)
+    return vtk_data
+
+def make_triangles(num_points=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    grid = vtk.vtkUnstructuredGrid()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(rng.random((num_points, 3)), deep=1))
+    grid.SetPoints(points)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.arange(0, 3 * num_points + 1, 3).astype(np.int64), deep=1),
+        numpy_support.numpy_to_vtkIdTypeArray(rng.integers(0, num_points, 3 * num_points).astype(np.int64), deep=1))
+    grid.SetCells(vtk.VTK_TRIANGLE, cells)
+    _add_array(grid, 's', rng.random(num_points))
+    _add_array(grid, 't', rng.random(num_points))
+    return _add_array(grid, 'v', rng.random((num_points, 3)))
+
+def make_points(num_points=500, seed=0):
+    grid = make_triangles(num_points, seed)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.arange(num_points + 1).astype(np.int64), deep=1),
+        numpy_support.numpy_to_vtkIdTypeArray(np.arange(num_points).astype(np.int64), deep=1))
+    grid.SetCells(vtk.VTK_VERTEX, cells)
+    return grid
+
+def make_tetrahedra(num_points=400, seed=0):
+    # An unstructured volume: meshTopology Volume, but no dimensions
+    grid = make_triangles(num_points, seed)
+    rng = np.random.default_rng(seed)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.arange(0, num_points + 1, 4).astype(np.int64), deep=1),
+        numpy_support.numpy_to_vtkIdTypeArray(rng.integers(0, num_points, num_points).astype(np.int64), deep=1))
+    grid.SetCells(vtk.VTK_TETRA, cells)
+    return grid
+
+def make_volume(dimensions=(9, 7, 5), values=None):
+    image = vtk.vtkImageData()
+    image.SetDimensions(*dimensions)
+    num_points = int(np.prod(dimensions))
+    return _add_array(image, 's', np.arange(num_points, dtype='f8') if values is None else values)
+
+def make_mixed_polydata():
+    # Points, lines and polygons in one polydata
+    points = vtk.vtkPoints()
+    for i in range(10):
+        points.InsertNextPoint(i, i * 0.5, i * 0.25)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    cells = {name: vtk.vtkCellArray() for name in ('verts', 'lines', 'polys')}
+    for name, ids in (('verts', (9,)), ('lines', (0, 1)), ('lines', (1, 2, 3)), ('polys', (2, 3, 4)), ('polys', (4, 5, 6, 7)), ('polys', (5, 6, 7))):
+        cells[name].InsertNextCell(len(ids))
+        for i in ids:
+            cells[name].InsertCellPoint(i)
+    polydata.SetVerts(cells['verts'])
+    polydata.SetLines(cells['lines'])
+    polydata.SetPolys(cells['polys'])
+    _add_array(polydata, 's', np.arange(10, dtype='f8'))
+    return _add_array(polydata, 'v', np.arange(30, dtype='f8').reshape(10, 3))
+
+def make_surface(seed=0):
+    # Polydata with only polygons
+    surface = vtk.vtkSphereSource()
+    surface.SetThetaResolution(16)
+    surface.SetPhiResolution(12)
+    surface.Update()
+    polydata = surface.GetOutput()
+    return _add_array(polydata, 's', np.random.default_rng(seed).random(polydata.GetNumberOfPoints()))
+
+def to_unstructured(vtk_data):
+    # The same cells in an unstructured grid
+    append = vtk.vtkAppendFilter()
+    append.SetInputData(vtk_data)
+    append.Update()
+    return append.GetOutput()
+
+def make_mixed():
+    # Points, lines and polygons in one unstructured grid
+    return to_unstructured(make_mixed_polydata())
+
+def _with_bad_values(vtk_data):
+    # NaNs, infinities and values out of float32 range in the first array
+    # and the points
+    values = numpy_support.vtk_to_numpy(vtk_data.GetPointData().GetArray(0))
+    values[::7] = np.nan
+    values[1::11] = np.inf
+    values[2::13] = -np.inf
+    values[3::17] = 1e300
+    if vtk_data.GetPoints() is not None:
+        points = numpy_support.vtk_to_numpy(vtk_data.GetPoints().GetData())
+        points[5] = np.nan
+        points[6, 2] = 1e300
+    return vtk_data
+
+def make_float32_volume():
+    values = np.linspace(-1, 1, 120).astype('f4')
+    values[4] = np.inf
+    values[9] = np.nan
+    return make_volume((6, 5, 4), values)
+
+# Datasets by name, built fresh for each test
+DATASETS = {
+    'triangles': lambda: _with_bad_values(make_triangles()),
+    'points': make_points,
+    'volume': lambda: _with_bad_values(make_volume()),
+    'float32_volume': make_float32_volume,
+    'mixed': make_mixed,
+    'tetrahedra': lambda: _with_bad_values(make_tetrahedra()),
+}
+
+@pytest.fixture(params=sorted(DATASETS))
+def dataset(request):
+    return request.param, DATASETS[request.param]()
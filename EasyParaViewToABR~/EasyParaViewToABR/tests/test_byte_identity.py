@@ -0,0 +1,96 @@
+# test_byte_identity.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# With default output options, every conversion path must give the header and
+# payload the original ABRDataFormat gave, byte for byte, since that is what
+# Unity reads.
+
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+from vtk.util import numpy_support
+
+from abr_data_format import ABRDataFormat, ABRDataReader
+from abr_data_format.ABRDataFormat import get_cell_arrays
+from baseline_abr_data_format import ABRDataFormat as BaselineABRDataFormat
+from conftest import make_mixed_polydata, make_surface, make_volume, to_unstructured
+
+# Values out of float32 range overflow, as they always have
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+LABEL = 'Org/Dataset/KeyData/Name'
+
+# Options that change how the output is made, not what it is
+OPTIONS = {
+    'default': {},
+    'arena': dict(arena=True),
+    'fused': dict(kernel='fused'),
+    'workers': dict(kernel='fused', workers=3),
+    'arena_workers': dict(arena=True, workers=2),
+    'profile': dict(profile=True),
+    'profile_memory': dict(profile='memory', arena=True),
+}
+
+def _same_header(formatted, baseline):
+    return json.loads(json.dumps(formatted.json_header)) == json.loads(json.dumps(baseline.json_header))
+
+@pytest.mark.parametrize('options', sorted(OPTIONS))
+def test_payload_matches_baseline(dataset, options):
+    _, vtk_data = dataset
+    baseline = BaselineABRDataFormat(vtk_data, LABEL)
+    formatted = ABRDataFormat(vtk_data, LABEL, **OPTIONS[options])
+    assert _same_header(formatted, baseline)
+    assert formatted.bufsize == baseline.bufsize
+    assert formatted.get_data_bytes() == baseline.get_data_bytes()
+
+    target = io.BytesIO()
+    assert formatted.write_into(target) == baseline.bufsize
+    assert target.getvalue() == baseline.get_data_bytes()
+
+@pytest.mark.parametrize('slab_budget', [64, 1000, 1 << 28])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_deferred_save_matches_baseline(dataset, tmp_path, slab_budget, workers):
+    _, vtk_data = dataset
+    baseline = BaselineABRDataFormat(vtk_data, LABEL)
+    formatted = ABRDataFormat(vtk_data, LABEL, deferred=True, workers=workers)
+    path = formatted.save(str(tmp_path), slab_budget=slab_budget)
+    with open(path + '.bin', 'rb') as f:
+        assert f.read() == baseline.get_data_bytes()
+    with open(path + '.json') as f:
+        assert json.load(f) == json.loads(json.dumps(baseline.json_header))
+    assert formatted.get_data_bytes() == baseline.get_data_bytes()
+
+    reader = ABRDataReader(path)
+    assert reader.get_data_bytes() == baseline.get_data_bytes()
+    target = io.BytesIO()
+    reader.write_into(target)
+    assert target.getvalue() == baseline.get_data_bytes()
+
+def test_deferred_save_of_empty_payload(tmp_path):
+    formatted = ABRDataFormat(make_volume(), LABEL, deferred=True, implicit_point_indices=True, exclude=['*'])
+    path = formatted.save(str(tmp_path))
+    assert formatted.bufsize == 0
+    assert os.path.getsize(path + '.bin') == 0
+    assert formatted.get_data_bytes() == b''
+    assert ABRDataReader(path).get_data_bytes() == b''
+
+@pytest.mark.parametrize('make_polydata', [make_surface, make_mixed_polydata])
+def test_polydata_matches_unstructured(make_polydata):
+    # The original reads polydata only once it is an unstructured grid
+    polydata = make_polydata()
+    baseline = BaselineABRDataFormat(to_unstructured(polydata), LABEL)
+    formatted = ABRDataFormat(polydata, LABEL)
+    assert _same_header(formatted, baseline)
+    assert formatted.get_data_bytes() == baseline.get_data_bytes()
+
+def test_polydata_cells_are_views():
+    polydata = make_surface()
+    offsets, connectivity = get_cell_arrays(polydata)
+    polys = polydata.GetPolys()
+    assert np.shares_memory(offsets, numpy_support.vtk_to_numpy(polys.GetOffsetsArray()))
+    assert np.shares_memory(connectivity, numpy_support.vtk_to_numpy(polys.GetConnectivityArray()))
@@ -0,0 +1,40 @@
+# test_profile.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# The stages a profiled conversion records, and the payload bytes of each.
+
+import pytest
+
+from abr_data_format import ABRDataFormat
+from conftest import make_triangles
+
+LABEL = 'Org/Dataset/KeyData/Name'
+
+def _stage_bytes(formatted):
+    return {record['stage']: record['bytes'] for record in formatted.profile.stages}
+
+@pytest.mark.parametrize('index_layout', ['legacy', 'offsets'])
+def test_stage_bytes_add_up(index_layout):
+    vtk_data = make_triangles()
+    formatted = ABRDataFormat(vtk_data, LABEL, profile=True, index_layout=index_layout)
+    stages = _stage_bytes(formatted)
+    num_cells = vtk_data.GetNumberOfCells()
+    # The legacy layout counts the points of each cell before its indices
+    if index_layout == 'legacy':
+        assert stages['cells'] == 4 * 4 * num_cells
+        assert stages.get('cell_offsets', 0) == 0
+    else:
+        assert stages['cells'] == 4 * 3 * num_cells
+        assert stages['cell_offsets'] == 4 * 2 * num_cells
+    assert sum(stages.values()) == formatted.bufsize
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_deferred_save_is_one_stage(tmp_path, workers):
+    formatted = ABRDataFormat(make_triangles(), LABEL, profile=True, deferred=True, workers=workers)
+    formatted.save(str(tmp_path))
+    stages = [record['stage'] for record in formatted.profile.stages]
+    assert stages.count('save') == 1
+    assert 'convert' not in stages
+    assert _stage_bytes(formatted)['save'] == formatted.bufsize
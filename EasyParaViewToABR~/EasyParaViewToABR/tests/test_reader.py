@@ -0,0 +1,111 @@
+# test_reader.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# What ABRDataFormat saves or sends, ABRDataReader reads back unchanged: for
+# every scalar encoding, index format and layout, and compression codec.
+
+import io
+import json
+
+import numpy as np
+import pytest
+
+from abr_data_format import ABRDataFormat, ABRDataReader
+from abr_data_format.Conversion import SCALAR_ENCODINGS
+from conftest import make_triangles
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+LABEL = 'Org/Dataset/KeyData/Name'
+
+LAYOUTS = {
+    'legacy': dict(index_layout='legacy'),
+    'offsets': dict(index_layout='offsets'),
+    'uint16': dict(index_format='uint16'),
+    'uint16_offsets': dict(index_format='uint16', index_layout='offsets'),
+}
+
+COMPRESSIONS = {
+    'zlib': dict(compression='zlib'),
+    'lzma': dict(compression='lzma', compression_level=1),
+    'zlib_filters': dict(compression='zlib', compression_filters='auto', compression_chunk_size=1 << 10),
+    'lzma_workers': dict(compression='lzma', compression_filters='auto', compression_chunk_size=1 << 10, workers=2),
+}
+
+# Largest decoding error of each scalar encoding, relative to the values
+STEPS = {'f32': 1e-6, 'f16': 2.0 ** -10, 'u16norm': 2.0 ** -15, 'u8norm': 2.0 ** -7}
+
+def _same_arrays(reader, formatted):
+    # The reader's sections, in payload order, are the payload
+    expected = {k: v for k, v in formatted.json_header.items() if k != 'compression'}
+    assert reader.json_header == json.loads(json.dumps(expected))
+    sections = _reader_sections(reader)
+    assert b''.join(np.ascontiguousarray(arr).tobytes() for arr in sections) == formatted.get_data_bytes()
+
+def _reader_sections(reader):
+    sections = []
+    if reader.vertex_array is not None:
+        sections.append(reader.vertex_array)
+    sections.append(reader.cells)
+    sections.extend(reader.scalar_arrays)
+    sections.extend(reader.vector_arrays)
+    if reader.cell_index_offsets is not None:
+        sections.extend([reader.cell_index_offsets, reader.cell_index_counts])
+    return sections
+
+@pytest.mark.parametrize('encoding', sorted(SCALAR_ENCODINGS))
+@pytest.mark.parametrize('layout', sorted(LAYOUTS))
+def test_save_round_trip(dataset, tmp_path, encoding, layout):
+    _, vtk_data = dataset
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding=encoding, **LAYOUTS[layout])
+    formatted.save(str(tmp_path))
+    reader = ABRDataReader.from_media(str(tmp_path), LABEL)
+    assert reader.label == LABEL
+    assert reader.get_data_bytes() == formatted.get_data_bytes()
+    _same_arrays(reader, formatted)
+
+    # Decoded values are within one quantization step of the scalar range
+    for i, name in enumerate(reader.json_header['scalarArrayNames']):
+        values = reader.get_scalar_values(name)
+        assert values.dtype == np.float32
+        low, high = reader.json_header['scalarMins'][i], reader.json_header['scalarMaxes'][i]
+        step = STEPS[encoding] * max(abs(low), abs(high), high - low)
+        values = values[np.isfinite(values)]
+        assert np.all((values >= low - step) & (values <= high + step))
+
+    # The reader sends and saves like the ABRDataFormat it came from
+    target = io.BytesIO()
+    assert reader.write_into(target) == formatted.bufsize
+    assert target.getvalue() == formatted.get_data_bytes()
+
+@pytest.mark.parametrize('compression', sorted(COMPRESSIONS))
+@pytest.mark.parametrize('encoding', ['f32', 'u8norm'])
+def test_compressed_round_trip(dataset, tmp_path, compression, encoding):
+    _, vtk_data = dataset
+    raw = ABRDataFormat(vtk_data, LABEL, scalar_encoding=encoding, index_layout='offsets')
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding=encoding, index_layout='offsets', **COMPRESSIONS[compression])
+    assert formatted.json_header['compression']['rawSize'] == raw.bufsize
+    payload = formatted.get_data_bytes()
+    assert len(payload) == formatted.bufsize
+
+    formatted.save(str(tmp_path))
+    reader = ABRDataReader.from_media(str(tmp_path), LABEL, workers=2)
+    assert reader.get_data_bytes() == raw.get_data_bytes()
+    _same_arrays(reader, raw)
+
+    received = ABRDataReader.from_payload(formatted.json_header, bytearray(payload), LABEL)
+    assert received.get_data_bytes() == raw.get_data_bytes()
+
+def test_from_payload_is_zero_copy():
+    formatted = ABRDataFormat(make_triangles(), LABEL)
+    payload = bytearray(formatted.get_data_bytes())
+    reader = ABRDataReader.from_payload(formatted.json_header, payload, LABEL)
+    reader.scalar_arrays[0][0] = 42
+    assert ABRDataReader.from_payload(formatted.json_header, payload).scalar_arrays[0][0] == 42
+
+def test_payload_size_is_checked():
+    formatted = ABRDataFormat(make_triangles(), LABEL)
+    with pytest.raises(ValueError):
+        ABRDataReader.from_payload(formatted.json_header, formatted.get_data_bytes()[:-4])
@@ -0,0 +1,72 @@
+# test_sender.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Sending to a Receiver: on new and pooled connections, and in the
+# background.
+
+import pytest
+
+from abr_data_format import ABRDataFormat
+from abr_data_format.Receiver import Receiver
+from abr_data_format.Sender import ConnectionPool, SendQueue, send_message
+from conftest import make_triangles
+
+LABEL = 'Org/Dataset/KeyData/Name'
+
+@pytest.fixture
+def receiver():
+    with Receiver() as receiver:
+        yield receiver
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_send_deferred(receiver, compression):
+    # The header is sent once conversion has filled in its ranges
+    formatted = ABRDataFormat(make_triangles(), LABEL, deferred=True, compression=compression)
+    assert send_message(*receiver.address, formatted) == 'ok'
+    expected = ABRDataFormat(make_triangles(), LABEL)
+    reader = receiver.datasets[LABEL]
+    assert reader.json_header['scalarMins'] == expected.json_header['scalarMins']
+    assert reader.get_data_bytes() == expected.get_data_bytes()
+
+def test_pool_reuses_connections(receiver):
+    pool = ConnectionPool()
+    formatted = ABRDataFormat(make_triangles(), LABEL)
+    for _ in range(3):
+        assert pool.send(*receiver.address, formatted) == 'ok'
+    assert pool.send_update(*receiver.address) == 'ok'
+    assert receiver.connections == 1
+    assert receiver.updates == 1
+    pool.close()
+
+def test_pool_closes_connection_on_error(receiver):
+    pool = ConnectionPool()
+    socks = []
+    def fail(sock):
+        socks.append(sock)
+        raise KeyError('not a socket error')
+    with pytest.raises(KeyError):
+        pool._call(receiver.address, fail)
+    assert socks[0].fileno() == -1
+    assert not pool._idle.get(receiver.address)
+
+def test_queue_counts_failed_sends():
+    queue = SendQueue()
+    queue.submit('sent', lambda: None)
+    queue.submit('returned False', lambda: False)
+    queue.submit('raised', lambda: 1 / 0)
+    assert queue.join(10)
+    stats = queue.stats()
+    assert (stats['sent'], stats['failed'], stats['dropped']) == (1, 2, 0)
+
+def test_queue_keeps_latest_per_key(receiver):
+    queue = SendQueue()
+    pool = ConnectionPool()
+    versions = [ABRDataFormat(make_triangles(seed=seed), LABEL) for seed in range(5)]
+    for formatted in versions:
+        queue.submit(LABEL, lambda formatted=formatted: pool.send(*receiver.address, formatted))
+    assert queue.join(10)
+    assert queue.sent + queue.dropped == len(versions)
+    assert receiver.datasets[LABEL].get_data_bytes() == versions[-1].get_data_bytes()
+    pool.close()
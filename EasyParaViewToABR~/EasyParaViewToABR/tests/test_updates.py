@@ -0,0 +1,205 @@
+# test_updates.py
+#
+# Copyright (c) 2021, Texas Advanced Computing Center and University of
+# Minnesota
+#
+# Resends, attribute updates and brick updates, sent to a Receiver: after
+# each one, the receiver's copy of the label matches the new version.
+
+import json
+
+import numpy as np
+import pytest
+from vtk.util import numpy_support
+
+from abr_data_format import ABRDataFormat, UnityMeshTopology
+from abr_data_format.Conversion import dequantize
+from abr_data_format.Receiver import Receiver
+from abr_data_format.Sender import ConnectionPool, send_message
+from abr_data_format.Updates import BrickDiff, Message, SectionHashes, make_attribute_update
+from conftest import make_tetrahedra, make_triangles, make_volume
+
+LABEL = 'Org/Dataset/KeyData/Name'
+
+@pytest.fixture
+def receiver():
+    with Receiver() as receiver:
+        yield receiver
+
+def _set_array(vtk_data, name, values):
+    numpy_support.vtk_to_numpy(vtk_data.GetPointData().GetArray(name))[:] = values
+
+def _received(receiver, formatted):
+    reader = receiver.datasets[formatted.label]
+    return reader.json_header == json.loads(json.dumps(formatted.json_header)) and reader.get_data_bytes() == formatted.get_data_bytes()
+
+def test_resend_reuses_unchanged_sections(receiver):
+    vtk_data = make_triangles()
+    table = SectionHashes()
+    message, hashes = table.make_update(ABRDataFormat(vtk_data, LABEL))
+    assert 'reuseSections' not in message.json_header
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, hashes)
+
+    _set_array(vtk_data, 't', np.linspace(0, 1, 1000))
+    formatted = ABRDataFormat(vtk_data, LABEL)
+    message, hashes = table.make_update(formatted)
+    assert 'scalars/t' not in message.json_header['reuseSections']
+    assert 'scalars/s' in message.json_header['reuseSections']
+    assert message.bufsize == 1000 * 4
+    assert send_message(*receiver.address, message) == 'ok'
+    assert _received(receiver, formatted)
+
+def test_resend_to_restarted_receiver(receiver):
+    vtk_data = make_triangles()
+    table = SectionHashes()
+    table.update(LABEL, table.make_update(ABRDataFormat(vtk_data, LABEL))[1])
+
+    # The receiver never got the first version
+    formatted = ABRDataFormat(vtk_data, LABEL)
+    message, hashes = table.make_update(formatted)
+    assert send_message(*receiver.address, message) == 'missing'
+    table.forget(LABEL)
+    message, hashes = table.make_update(formatted)
+    assert message.bufsize == formatted.bufsize
+    assert send_message(*receiver.address, message) == 'ok'
+    assert _received(receiver, formatted)
+
+@pytest.mark.parametrize('encoding', ['f32', 'u8norm'])
+def test_attribute_update(receiver, encoding):
+    vtk_data = make_triangles()
+    assert send_message(*receiver.address, ABRDataFormat(vtk_data, LABEL, scalar_encoding=encoding)) == 'ok'
+
+    # A new range for one array
+    _set_array(vtk_data, 's', np.linspace(-5, 5, 1000))
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding=encoding)
+    message = make_attribute_update(formatted, scalars=['s'], vectors=[])
+    assert message.bufsize == 1000 * (4 if encoding == 'f32' else 1)
+    assert send_message(*receiver.address, message) == 'ok'
+    assert _received(receiver, formatted)
+    assert receiver.datasets[LABEL].json_header['scalarMins'][0] == -5
+
+def test_attribute_update_needs_previous_version(receiver):
+    message = make_attribute_update(ABRDataFormat(make_triangles(), LABEL))
+    assert send_message(*receiver.address, message) == 'missing'
+
+def test_mismatched_payload_is_not_applied(receiver):
+    pool = ConnectionPool()
+    formatted = ABRDataFormat(make_triangles(), LABEL)
+    assert pool.send(*receiver.address, formatted) == 'ok'
+
+    # A payload too short for its header, and a resend that reuses a
+    # section the receiver does not have
+    short = Message(LABEL, ABRDataFormat(make_triangles(seed=1), LABEL).json_header, [b'\0' * 10])
+    assert pool.send(*receiver.address, short).startswith('error')
+    resend = Message(LABEL, dict(formatted.json_header, reuseSections=['scalars/nothing']), [])
+    assert pool.send(*receiver.address, resend).startswith('error')
+
+    # The previous version is kept, on the same connection
+    assert _received(receiver, formatted)
+    assert pool.send(*receiver.address, formatted) == 'ok'
+    assert receiver.connections == 1
+    pool.close()
+
+def _volume_values(seed=0):
+    return np.random.default_rng(seed).random(40 * 24 * 16)
+
+def test_brick_update(receiver):
+    values = _volume_values()
+    vtk_data = make_volume((40, 24, 16), values)
+    table = BrickDiff(brick_size=8)
+    formatted = ABRDataFormat(vtk_data, LABEL)
+    message, state = table.make_update(formatted)
+    assert message is formatted
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, state)
+
+    # Change one brick
+    values.reshape(16, 24, 40)[9, 3, 10] = 2
+    _set_array(vtk_data, 's', values)
+    formatted = ABRDataFormat(vtk_data, LABEL)
+    message, state = table.make_update(formatted)
+    assert message.json_header['update'] == 'bricks'
+    assert message.bufsize == 8 ** 3 * 4
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, state)
+    assert _received(receiver, formatted)
+
+    # Nothing changed
+    message, state = table.make_update(formatted)
+    assert message.bufsize == 0
+    assert send_message(*receiver.address, message) == 'ok'
+    assert _received(receiver, formatted)
+
+def test_brick_update_of_wrong_size(receiver):
+    vtk_data = make_volume((40, 24, 16), _volume_values())
+    formatted = ABRDataFormat(vtk_data, LABEL)
+    assert send_message(*receiver.address, formatted) == 'ok'
+    # One brick of values for two bricks
+    header = dict(formatted.json_header, update='bricks', brickSize=8, bricks=[[0, 1]])
+    message = Message(LABEL, header, [b'\0' * (8 ** 3 * 4)])
+    assert send_message(*receiver.address, message).startswith('error')
+    assert _received(receiver, formatted)
+
+def test_brick_update_with_tolerance(receiver):
+    values = _volume_values()
+    vtk_data = make_volume((40, 24, 16), values)
+    table = BrickDiff(brick_size=8, tolerance=0.1)
+    message, state = table.make_update(ABRDataFormat(vtk_data, LABEL))
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, state)
+
+    # Drift below the tolerance everywhere, one step after another, and a
+    # large change in one brick
+    rng = np.random.default_rng(1)
+    for step in range(5):
+        values += rng.uniform(-0.05, 0.05, values.shape)
+        if step == 2:
+            values.reshape(16, 24, 40)[0, 0, 0] += 1
+        _set_array(vtk_data, 's', values)
+        formatted = ABRDataFormat(vtk_data, LABEL)
+        message, state = table.make_update(formatted)
+        assert send_message(*receiver.address, message) == 'ok'
+        table.update(LABEL, state)
+        received = receiver.datasets[LABEL].get_scalar_array('s')
+        assert np.abs(received - formatted.scalar_arrays[0]).max() <= 0.1
+    assert message.bufsize < formatted.bufsize
+
+def test_brick_update_with_tolerance_and_new_range(receiver):
+    # Values quantized to the old range must not stay at the receiver once
+    # the range changes
+    values = _volume_values()
+    vtk_data = make_volume((40, 24, 16), values)
+    table = BrickDiff(brick_size=8, tolerance=2)
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding='u8norm')
+    message, state = table.make_update(formatted)
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, state)
+
+    values[0] = 10
+    _set_array(vtk_data, 's', values)
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding='u8norm')
+    message, state = table.make_update(formatted)
+    assert message is formatted
+    assert send_message(*receiver.address, message) == 'ok'
+    table.update(LABEL, state)
+    assert _received(receiver, formatted)
+
+    # Same range: bricks within the tolerance are left out
+    values[1] = 0.5
+    _set_array(vtk_data, 's', values)
+    formatted = ABRDataFormat(vtk_data, LABEL, scalar_encoding='u8norm')
+    message, state = table.make_update(formatted)
+    assert message.json_header['update'] == 'bricks'
+    assert send_message(*receiver.address, message) == 'ok'
+    # The tolerance is in steps of the stored values
+    header = formatted.json_header
+    expected = dequantize(formatted.scalar_arrays[0], 'u8norm', header['scalarMins'][0], header['scalarMaxes'][0])
+    step = (header['scalarMaxes'][0] - header['scalarMins'][0]) / 255
+    assert np.abs(receiver.datasets[LABEL].get_scalar_values('s') - expected).max() <= 2 * step + 1e-6
+
+def test_brick_update_needs_image_data():
+    formatted = ABRDataFormat(make_tetrahedra(), LABEL)
+    assert formatted.json_header['meshTopology'] == UnityMeshTopology.Volume
+    with pytest.raises(ValueError, match='image data'):
+        BrickDiff().make_update(formatted)